@@ -1,19 +1,20 @@
-import sys
-sys.path.append('../')
 from internal.datasets import Dataset
-import internal.datasets
-from internal import configs, math, utils
+from internal import utils
 
+from absl import logging
+
+import array
+import functools
 import os
 import time
 import cv2
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import jax
-from PIL import Image
-import queue
+import subprocess
+import tempfile
 import threading
-import json
-import gin
+import orjson
 
 
 def load_dataset(split, train_dir, config):
@@ -25,44 +26,529 @@ def load_dataset(split, train_dir, config):
 
 
 
+# Fixed dtypes for the metadata columns; float32 is enough for all the camera
+# parameters and halves the bytes read during ray generation.
+_META_DTYPES = {
+    'cam2world': np.float32,
+    'pix2cam': np.float32,
+    'near': np.float32,
+    'far': np.float32,
+    'lossmult': np.float32,
+    'time': np.float32,
+    'width': np.int32,
+    'height': np.int32,
+    'image_id': np.int32,
+}
+
+
+def _is_ragged(value):
+    """Whether `value` is a list of lists that do not all have the same length."""
+    if not isinstance(value, list) or not value or not isinstance(value[0], list):
+        return False
+    return any(not isinstance(v, list) or len(v) != len(value[0]) for v in value)
+
+
+def meta_array(key, value):
+    """Converts one metadata column into a contiguous, explicitly typed array.
+
+    Columns without a fixed dtype keep numpy's inferred one, except that
+    float64 is narrowed to float32. Ragged columns (e.g. per-camera frame
+    lists) become an `ak.Array`, which stores them flat with offsets instead of
+    as an object array, so they can still be indexed without Python loops.
+    """
+    if _is_ragged(value):
+        # imported here so awkward is only needed by datasets with ragged columns.
+        import awkward as ak  # pylint: disable=g-import-not-at-top
+        return ak.Array(value)
+    dtype = _META_DTYPES.get(key)
+    if dtype is not None:
+        return np.ascontiguousarray(value, dtype=dtype)
+    value = np.asarray(value)
+    if value.dtype == np.float64:
+        value = value.astype(np.float32)
+    return value
+
+
 def write_meta(meta, config, save_meta=True):
   if save_meta and jax.host_id() == 0:
     os.makedirs(config.checkpoint_dir)
-    with open(config.checkpoint_dir + '/meta.txt', 'w') as f:
+    with open(config.checkpoint_dir + '/meta.txt', 'wb') as f:
       # write the meta txt file
-      f.write(json.dumps(meta, indent=4))
+      option = orjson.OPT_SERIALIZE_NUMPY
+      if config.debug_meta:
+        option |= orjson.OPT_INDENT_2
+      f.write(orjson.dumps(meta, option=option))
+
+
+def _split_metadata_file(meta_path, split, cache_dir):
+    """Returns the path of the `split` metadata, splitting `meta_path` once.
+
+    Host 0 parses `metadata.json` and writes every split into `cache_dir` as
+    `metadata_{split}.json`, rewriting them once they are older than
+    `metadata.json`; later loads then only parse the split they use. The other
+    hosts wait for host 0 on a barrier before they look for the file. Returns
+    None if there is no up to date split file, e.g. if it could not be written
+    or `cache_dir` is not shared with this host.
+    """
+    root, ext = os.path.splitext(os.path.basename(meta_path))
+    split_path = os.path.join(cache_dir, f'{root}_{split}{ext}')
+
+    def is_fresh(p):
+        return (os.path.exists(p) and
+                os.path.getmtime(p) >= os.path.getmtime(meta_path))
+
+    if jax.host_id() == 0 and not is_fresh(split_path):
+        try:
+            with utils.open_file(meta_path, 'rb') as f:
+                all_meta = orjson.loads(f.read())
+            os.makedirs(cache_dir, exist_ok=True)
+            for name, meta in all_meta.items():
+                # write then rename so concurrent loaders never see partial
+                # files.
+                path = os.path.join(cache_dir, f'{root}_{name}{ext}')
+                tmp_path = f'{path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(orjson.dumps(meta))
+                os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning('Could not split %s into %s: %s', meta_path,
+                            cache_dir, e)
+    if jax.host_count() > 1:
+        # imported here so single host runs never need it.
+        from jax.experimental import multihost_utils  # pylint: disable=g-import-not-at-top
+        multihost_utils.sync_global_devices(f'regnerf_metadata_{split}')
+    return split_path if is_fresh(split_path) else None
+
+
+def prefetch_files(paths):
+    """Asks the kernel to start reading `paths` into the page cache.
+
+    The readahead for every file is queued up front and runs asynchronously,
+    so the decoders later find the video data in memory instead of each
+    issuing its own blocking reads. No-op where posix_fadvise is unavailable.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for p in paths:
+        fd = os.open(p, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+
+def open_video(video_path):
+    """Opens a video and keeps OpenCV's internal decode buffer to one frame.
+
+    The FFmpeg backend is asked for any available hardware decoder (NVDEC,
+    VAAPI, VideoToolbox). This needs OpenCV built with WITH_FFMPEG=ON against
+    an FFmpeg with hardware decoding enabled; otherwise, and on OpenCV releases
+    without the hardware acceleration properties, decoding stays on the CPU.
+    """
+    cap = None
+    if hasattr(cv2, 'VIDEO_ACCELERATION_ANY'):
+        cap = cv2.VideoCapture(video_path, cv2.CAP_FFMPEG, [
+            cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY])
+    if cap is None or not cap.isOpened():
+        cap = cv2.VideoCapture(video_path)
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    return cap
+
+
+def video_frame_shape(cap):
+    """Returns the `(height, width)` of an opened video."""
+    return (int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)))
+
+
+def iter_video_frames(cap, n_frames, stride=1, out=None):
+    """Yields `(t, frame)` for every `stride`-th frame of an opened video.
+
+    The frames in between are only grabbed (demuxed), never retrieved, so they
+    never pay for the decode and colour conversion. Frames are RGB: OpenCV's
+    BGR output is retrieved into one reused buffer and swizzled by `cvtColor`,
+    writing straight into `out[t]` if `out` is given.
+    """
+    bgr = None
+    for i in range(n_frames):
+        if not cap.grab():
+            break
+        if i % stride == 0:
+            t = i // stride
+            _, bgr = cap.retrieve(bgr)
+            if out is None:
+                frame = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+            else:
+                frame = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=out[t])
+                if not np.shares_memory(frame, out):
+                    out[t] = frame
+                    frame = out[t]
+            yield t, frame
+
+
+def num_strided_frames(n_frames, stride):
+    """Number of frames kept when decoding every `stride`-th of `n_frames`."""
+    return -(-n_frames // stride)
+
+
+class _FFmpegReader:
+    """Reads raw frames straight from an ffmpeg subprocess pipe.
+
+    Frames are read from the unbuffered pipe straight into a freshly allocated
+    numpy array with `readinto`, skipping the intermediate bytes object that
+    `cv2.VideoCapture` copies every frame through. ffmpeg emits RGB directly, so
+    no colour conversion is needed on our side.
+    """
+
+    __slots__ = ('height', 'width', 'framesize', 'proc')
+
+    def __init__(self, video_path, height, width, stride=1):
+        self.height = height
+        self.width = width
+        self.framesize = height * width * 3
+        cmd = ['ffmpeg', '-loglevel', 'error', '-hwaccel', 'auto',
+               '-i', video_path]
+        if stride > 1:
+            cmd += ['-vf', f'select=not(mod(n\\,{stride}))']
+        cmd += ['-vsync', '0', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-']
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=0)
+
+    def read_frame(self, out=None):
+        """Returns the next frame, or None once the stream is exhausted.
 
+        If `out` is given, the frame is read in place into it.
+        """
+        frame = out
+        if frame is None:
+            frame = np.empty((self.height, self.width, 3), np.uint8)
+        buf = memoryview(frame).cast('B')
+        readinto = self.proc.stdout.readinto
+        framesize = self.framesize
+        n_read = 0
+        # Pipes return short reads, keep filling until the frame is complete.
+        while n_read < framesize:
+            n = readinto(buf[n_read:])
+            if not n:
+                return None
+            n_read += n
+        return frame
+
+    def iter_frames(self, n_frames, out=None):
+        """Yields `(t, frame)` for at most `n_frames` frames, into `out[t]`."""
+        for t in range(n_frames):
+            frame = self.read_frame(None if out is None else out[t])
+            if frame is None:
+                break
+            yield t, frame
+
+    def release(self):
+        self.proc.stdout.close()
+        self.proc.kill()
+        self.proc.wait()
+
+
+class _SPSCFrameRing:
+    """Single-producer single-consumer ring over one camera's frame slots.
+
+    The frames themselves are decoded in place into the camera's slice of the
+    preallocated video array, so the ring only tracks how many frames the
+    decoder has published (`head`) and the consumer has taken (`tail`). Each
+    counter is a single machine word written by one thread only, so neither
+    side takes a lock per frame; `not_full` is only waited on when the producer
+    runs `slots` frames ahead.
+    """
+
+    __slots__ = ('slots', 'head', 'tail', 'closed', 'not_full')
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.head = array.array('Q', [0])
+        self.tail = array.array('Q', [0])
+        self.closed = False
+        self.not_full = threading.Event()
+
+    def push(self, stop_event):
+        """Publishes the next frame, False if stopped while the ring was full."""
+        head, tail = self.head, self.tail
+        while head[0] - tail[0] >= self.slots:
+            self.not_full.clear()
+            # re-check after clearing so a concurrent pop cannot be missed.
+            if head[0] - tail[0] < self.slots:
+                break
+            self.not_full.wait(0.1)
+            if stop_event.is_set():
+                return False
+        head[0] += 1
+        return True
+
+    def pop(self):
+        """Returns the index of the next published frame, or None if empty."""
+        t = self.tail[0]
+        if t == self.head[0]:
+            return None
+        self.tail[0] = t + 1
+        self.not_full.set()
+        return t
+
+
+class _DecoderPool:
+    """Decodes one video per camera on a pool of worker threads.
+
+    Camera `c` is decoded in place into `out[c]`, a `[T, H, W, 3]` slice of one
+    preallocated uint8 array. OpenCV and ffmpeg release the GIL while decoding,
+    so up to one worker per CPU core decodes in parallel. Every decoder
+    publishes its frames through its own `_SPSCFrameRing` and stalls once it is
+    `active_gen_cap / n_cams` frames ahead of the consumer.
+    """
+
+    def __init__(self, video_paths, out, n_frames, stride=1, active_gen_cap=0,
+                 use_ffmpeg_raw=False):
+        self.video_paths = video_paths
+        self.out = out
+        self.n_frames = n_frames
+        self.stride = stride
+        self.use_ffmpeg_raw = use_ffmpeg_raw
+        slots = max(1, active_gen_cap // len(video_paths)) if active_gen_cap else 4
+        self.rings = [_SPSCFrameRing(slots) for _ in video_paths]
+        # set by the decoders whenever they publish, cleared by the consumer.
+        self.published = threading.Event()
+        self.stop_event = threading.Event()
+        self.executor = ThreadPoolExecutor(
+            max_workers=min(len(video_paths), os.cpu_count() or 1))
+        self.futures = []
+
+    def start(self):
+        self.futures = [
+            self.executor.submit(self._decode_one_camera, cam_id, video_path)
+            for cam_id, video_path in enumerate(self.video_paths)
+        ]
+
+    def stop(self):
+        self.stop_event.set()
+        self.executor.shutdown(wait=False)
+
+    def _decode_one_camera(self, cam_id, video_path):
+        out = self.out[cam_id]
+        ring = self.rings[cam_id]
+        reader = None
+        # open inside the `try` so a reader that fails to start (e.g. no ffmpeg
+        # on PATH) still closes the ring instead of leaving the consumer waiting.
+        try:
+            if self.use_ffmpeg_raw:
+                reader = _FFmpegReader(video_path, *out.shape[1:3],
+                                       stride=self.stride)
+                frames = reader.iter_frames(out.shape[0], out)
+            else:
+                reader = open_video(video_path)
+                frames = iter_video_frames(reader, self.n_frames, self.stride,
+                                           out)
+            for _ in frames:
+                if self.stop_event.is_set() or not ring.push(self.stop_event):
+                    break
+                self.published.set()
+        finally:
+            if reader is not None:
+                reader.release()
+            ring.closed = True
+            self.published.set()
+
+    def __iter__(self):
+        """Yields `(cam_id, t, frame)` until every camera has finished."""
+        running = set(range(len(self.rings)))
+        while running:
+            self.published.clear()
+            n_popped = 0
+            for cam_id in list(running):
+                ring = self.rings[cam_id]
+                # read `closed` before draining so no final frame is missed.
+                closed = ring.closed
+                t = ring.pop()
+                while t is not None:
+                    n_popped += 1
+                    yield cam_id, t, self.out[cam_id, t]
+                    t = ring.pop()
+                if closed:
+                    running.discard(cam_id)
+                    # re-raise a decoding error as soon as its camera closes,
+                    # not only after every other camera has finished.
+                    self.futures[cam_id].result()
+            if running and not n_popped:
+                self.published.wait(0.1)
 
 
 class Multicam_video(Dataset):
 
+    @classmethod
+    @functools.lru_cache(maxsize=4)
+    def _load_all_splits(cls, meta_path):
+        """Parses every split of a metadata file once, memoized per path.
+
+        Returns `{split: {column: array}}`. Every host reads the metadata, but
+        constructing another dataset from the same file in this process (e.g.
+        the test split after the train split, or repeatedly during eval)
+        neither re-reads nor re-parses the JSON.
+        """
+        with utils.open_file(meta_path, 'rb') as f:
+            all_meta = orjson.loads(f.read())
+        return {
+            split: {k: meta_array(k, v) for k, v in meta.items()}
+            for split, meta in all_meta.items()
+        }
+
+    @classmethod
+    @functools.lru_cache(maxsize=8)
+    def _load_split(cls, split_path):
+        """Parses a single-split metadata file, memoized per path."""
+        with utils.open_file(split_path, 'rb') as f:
+            meta = orjson.loads(f.read())
+        return {k: meta_array(k, v) for k, v in meta.items()}
+
+    def _decode_videos(self, config, video_paths, out):
+        """Decodes camera `c` into `out[c]`, returns the usable frame count."""
+        pool = _DecoderPool(video_paths, out, self.time_frame_num,
+                            config.video_frame_stride,
+                            config.video_decode_queue_size,
+                            config.use_ffmpeg_raw)
+        pool.start()
+        # the frame count in the container header can overestimate, so keep
+        # only the frames every camera actually decoded.
+        decoded = np.zeros(len(video_paths), int)
+        try:
+            for cam_idx, t, _ in pool:
+                decoded[cam_idx] = t + 1
+        finally:
+            pool.stop()
+        return int(decoded.min())
+
+    def _share_decoded_videos(self, config, video_paths, shape):
+        """Decodes the videos once per host into a file, maps them elsewhere.
+
+        The files live in `config.video_share_dir`, the system temp directory
+        if unset. The first process on each host to claim the run's lock file
+        decodes into a memmap there, the other processes on that host wait for
+        its sentinel and map the same pages read-only. Every file is named by
+        a token that process 0 draws for this run, so neither a previous run's
+        files nor a concurrent job's are ever picked up, and all of them are
+        unlinked once every process has mapped the frames.
+
+        Returns the `(videos, frame_num)` of `_decode_videos`.
+        """
+        # imported here so only runs that share decoded videos need it.
+        from jax.experimental import multihost_utils  # pylint: disable=g-import-not-at-top
+        token = int(multihost_utils.broadcast_one_to_all(
+            np.int32(int.from_bytes(os.urandom(4), 'little') & 0x7fffffff)))
+        name = f'regnerf_{token:08x}_{self.split}'
+        base = os.path.join(config.video_share_dir or tempfile.gettempdir(),
+                            name)
+        frames_path, ready_path, lock_path = (
+            base + '.u8', base + '.ready', base + '.lock')
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            is_decoder = True
+        except FileExistsError:
+            is_decoder = False
+        if is_decoder:
+            frame_num = -1
+            try:
+                videos = np.memmap(frames_path, np.uint8, 'w+', shape=shape)
+                frame_num = self._decode_videos(config, video_paths, videos)
+                videos.flush()
+            finally:
+                # publish failures too (-1) so the waiting processes raise.
+                with open(ready_path + '.tmp', 'w') as f:
+                    f.write(str(frame_num))
+                os.replace(ready_path + '.tmp', ready_path)
+                if frame_num < 0 and os.path.exists(frames_path):
+                    os.unlink(frames_path)
+        else:
+            while not os.path.exists(ready_path):
+                time.sleep(0.5)
+            with open(ready_path) as f:
+                frame_num = int(f.read())
+            if frame_num < 0:
+                raise RuntimeError(
+                    f'Another process failed to decode into {frames_path}.')
+            videos = np.memmap(frames_path, np.uint8, 'r', shape=shape)
+        # once every process is past this barrier all of them have mapped the
+        # frames, the mapped pages then outlive the names until the last exit.
+        multihost_utils.sync_global_devices(name)
+        if is_decoder:
+            for p in (frames_path, ready_path, lock_path):
+                os.unlink(p)
+        return videos, frame_num
+
     def _load_renderings(self, config):
-        videos = []
-        cap = cv2.VideoCapture(self._path)
-        self.time_frame_num = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        print("we have {self.time_frame_num} frames in total for each videos from each camera.")
-        
         if config.render_path:
             raise ValueError('render_path not supported for multicam video dataset.')
         
         # read the meta data:
-        with utils.open_file(os.path.join(self._path, 'metadata.json'), 'r') as f:
-            print("Now we are loading the metadata from {self.split} split.", self.split)
-            self.meta = json.load(f)[self.split]
+        print("Now we are loading the metadata from {self.split} split.", self.split)
+        # copy the cached dict so per-instance edits never leak into the cache.
+        meta_path = os.path.join(self._path, 'metadata.json')
+        cache_dir = config.metadata_cache_dir or config.checkpoint_dir
+        split_path = (_split_metadata_file(meta_path, self.split, cache_dir)
+                      if cache_dir else None)
+        if split_path is None:
+            all_splits = self._load_all_splits(meta_path)
+            if self.split not in all_splits:
+                raise KeyError(f'Split {self.split!r} is not in {meta_path}, '
+                               f'which has {sorted(all_splits)}.')
+            self.meta = dict(all_splits[self.split])
+        else:
+            self.meta = dict(self._load_split(split_path))
 
-        self.meta = {k: np.array(self.meta[k]) for k in self.meta}
+        # one video per camera, decoded concurrently.
+        cam_num = self.meta['cam2world'].shape[0]
+        video_paths = [os.path.join(self._path_videodir, f'cam_{cam_idx+1}.mp4')
+                       for cam_idx in range(cam_num)]
+        if config.prefetch_videos:
+            prefetch_files(video_paths)
+        cap = open_video(video_paths[0])
+        self.time_frame_num = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        height, width = video_frame_shape(cap)
+        cap.release()
+        print("we have {self.time_frame_num} frames in total for each videos from each camera.")
 
-        # write the self.meta into the out path for saving the meta data, check if it is correct
-        # or not???? 
+        # decode straight into one [cam_num, T, H, W, 3] array.
+        shape = (cam_num,
+                 num_strided_frames(self.time_frame_num,
+                                    config.video_frame_stride),
+                 height, width, 3)
+        if not config.share_decoded_videos:
+            self.videos = np.empty(shape, np.uint8)
+            frame_num = self._decode_videos(config, video_paths, self.videos)
+        else:
+            self.videos, frame_num = self._share_decoded_videos(
+                config, video_paths, shape)
+        self.videos = self.videos[:, :frame_num]
+        # Frames stay quantized on host, and on device with videos_on_device.
+        assert self.videos.dtype == np.uint8, self.videos.dtype
+        self.videos_device = None
+        if config.videos_on_device and self.device_sampling:
+            # upload once, `_device_images` then takes the trained frame out
+            # of this copy instead of uploading the images a second time.
+            self.videos_device = jax.device_put(self.videos)
 
-        with utils.open_file(os.path.join(self._path, 'metadata.json'), 'w') as f:
-            json.dump(self.meta, f, indent=4)
-            
+        # the frame at start_frame is trained on, one image per camera.
+        self.train_frame = min(self.start_frame // config.video_frame_stride,
+                               frame_num - 1)
+        self.images = self.videos[:, self.train_frame]
+        self.n_examples = cam_num
 
+    def _device_images(self):
+        """Slices the trained frame out of the resident videos on device.
 
+        `_sample_batch` then gathers and dequantizes the uint8 pixels in the
+        jitted step, so the videos cross to the device once. The downsampled
+        scales are still uploaded from the host.
+        """
+        if self.videos_device is None:
+            return super()._device_images()
+        frame = self.videos_device[:, self.train_frame].reshape(-1, 3)
+        return [frame] + [jax.device_put(i) for i in self.images[1:]]
 
 
 
 class Blender_video(Dataset):
     def _load_renderings(self, config):
-        videos = []
\ No newline at end of file
+        videos = []
@@ -54,11 +54,46 @@ class Config:
   start_frame: int = 100
   end_frame: int =120
   render_frame: int = 20
+  video_frame_stride: int = 1  # Decode every Nth frame of the input videos.
+  video_decode_queue_size: int = 0  # Decoded frames in flight, 0 for 4 per cam.
+  use_ffmpeg_raw: bool = False  # If True, decode through an ffmpeg subprocess.
+  prefetch_videos: bool = False  # If True, read ahead all videos (Linux only).
+  # If True, one process per host decodes the videos into a file and the other
+  # processes on that host map it instead of decoding again.
+  share_decoded_videos: bool = False
+  # Where share_decoded_videos puts the file, e.g. '/dev/shm' to keep it in
+  # memory; the system temp directory if empty.
+  video_share_dir: str = ''
+  debug_meta: bool = False  # If True, write the saved metadata indented.
+  # If True with device_sampling, upload the decoded uint8 videos to device
+  # once and sample the trained frame from that copy.
+  videos_on_device: bool = False
+  # Where per-split copies of metadata.json are cached, checkpoint_dir if empty.
+  metadata_cache_dir: str = ''
   # end of the new added configs to support the video configuration.
 
   dataset_loader: str = 'dtu'  # The type of dataset loader to use.
   batching: str = 'single_image'  # Batch composition.
   batching_random: str = 'all_images'  # Batch composiiton for random views.
+  # If True, keep the training rays on device and sample 'all_images' batches
+  # there instead of on the host.
+  device_sampling: bool = False
+  ray_dtype: str = 'float32'  # Storage dtype of rays: float32/float16/bfloat16.
+  # Storage dtype of the ray radii if set, e.g. 'float16' to keep the other
+  # fields in ray_dtype. Applies to test and random rays, the packed training
+  # rays keep their radii in ray_dtype.
+  radii_dtype: str = ''
+  # If True, training images are stored as uint8 and every sampled batch is
+  # dequantized by datasets.images_to_float, to bfloat16 if ray_dtype is
+  # 'bfloat16' and to float32 otherwise.
+  uint8_images: bool = False
+  prefetch_depth: int = 8  # Batches prepared ahead by the data thread, >= 3.
+  debug_dump: bool = False  # If True, dump rays and batches to checkpoint_dir.
+  ray_cache_dir: str = ''  # If set, cache generated Multicam rays there.
+  # If True, the rays of the downsampled scales are strided views of the full
+  # resolution rays instead of being regenerated; each ray is then off the
+  # center of its downsampled pixel by (factor - 1) / 2 full resolution pixels.
+  strided_downsampled_rays: bool = False
   batch_size: int = 2048  # The number of rays/pixels in each batch.
   batch_size_random: int = 2048  # The number of rays/pixels in each batch.
   factor: int = 0  # The downsample factor of images, 0 for no downsampling.
@@ -14,20 +14,41 @@
 # limitations under the License.
 
 """Different datasets implementation plus a general port for all the datasets."""
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
 import json
 import os
 from os import path
 import queue
+import shutil
 import threading
 
 from internal import math, utils  # pylint: disable=g-multiple-import
 import jax
+import jax.numpy as jnp
 import numpy as np
 from PIL import Image
 
 
 import cv2
 
+try:
+  import numba  # pylint: disable=g-import-not-at-top
+except ImportError:
+  numba = None
+
+_RAY_DTYPES = {
+    'float32': np.float32,
+    'float16': np.float16,
+    'bfloat16': jnp.bfloat16,
+}
+
+# Part of every ray cache key, bump it whenever the cached arrays change
+# meaning, e.g. a new ray convention or a different on-disk layout.
+_RAY_CACHE_VERSION = 1
+
 
 def load_dataset(split, train_dir, config):
   """Loads a split of a dataset using the data_loader specified by `config`."""
@@ -112,21 +133,51 @@ def convert_to_ndc(origins, directions, focal, width, height, near=1.,
   return origins_ndc, directions_ndc
 
 
-def downsample(img, factor, patch_size=-1, mode=cv2.INTER_AREA):
-  """Area downsample img (factor must evenly divide img height and width)."""
+def downsample(img, factor, patch_size=-1, mode=cv2.INTER_AREA, dst=None):
+  """Area downsample img (factor must evenly divide img height and width).
+
+  If given, `dst` is a preallocated output of the downsampled shape and dtype.
+  """
   sh = img.shape
   max_fn = lambda x: max(x, patch_size)
   out_shape = (max_fn(sh[1] // factor), max_fn(sh[0] // factor))
-  img = cv2.resize(img, out_shape, mode)
+  img = cv2.resize(img, out_shape, dst=dst, interpolation=mode)
+  if dst is not None and not np.shares_memory(img, dst):
+    dst[:] = img
+    img = dst
   return img
 
 
+def _thread_map(fn, items):
+  """Returns `[fn(x) for x in items]`, computed on a pool of threads.
+
+  The loaders use it for image decoding and resizing: PIL and OpenCV release
+  the GIL there, so the items are processed in parallel.
+  """
+  with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+    return list(executor.map(fn, items))
+
+
+PoseStats = collections.namedtuple(
+    'PoseStats', ['positions', 'mean_position', 'mean_z', 'mean_up'])
+
+
+def _pose_stats(poses):
+  """Per-axis statistics of [N, 3, 4] poses shared by the path helpers."""
+  positions = poses[:, :3, 3]
+  return PoseStats(
+      positions=positions,
+      mean_position=positions.mean(0),
+      mean_z=poses[:, :3, 2].mean(0),
+      mean_up=poses[:, :3, 1].mean(0))
+
+
 def focus_pt_fn(poses):
   """Calculate nearest point to all focal axes in poses."""
   directions, origins = poses[:, :3, 2:3], poses[:, :3, 3:4]
   m = np.eye(3) - directions * np.transpose(directions, [0, 2, 1])
   mt_m = np.transpose(m, [0, 2, 1]) @ m
-  focus_pt = np.linalg.inv(mt_m.mean(0)) @ (mt_m @ origins).mean(0)[:, 0]
+  focus_pt = np.linalg.solve(mt_m.mean(0), (mt_m @ origins).mean(0)[:, 0])
   return focus_pt
 
 
@@ -155,27 +206,36 @@ def shift_origins(origins, directions, near=0.0):
   return origins
 
 
-def poses_avg(poses):
+def poses_avg(poses, stats=None):
   """New pose using average position, z-axis, and up vector of input poses."""
-  position = poses[:, :3, 3].mean(0)
-  z_axis = poses[:, :3, 2].mean(0)
-  up = poses[:, :3, 1].mean(0)
-  cam2world = viewmatrix(z_axis, up, position)
+  if stats is None:
+    stats = _pose_stats(poses)
+  cam2world = viewmatrix(stats.mean_z, stats.mean_up, stats.mean_position)
   return cam2world
 
 
 def viewmatrix(lookdir, up, position, subtract_position=False):
-  """Construct lookat view matrix."""
+  """Construct lookat view matrix, batched over any leading dimensions."""
   vec2 = normalize((lookdir - position) if subtract_position else lookdir)
   vec0 = normalize(np.cross(up, vec2))
   vec1 = normalize(np.cross(vec2, vec0))
-  m = np.stack([vec0, vec1, vec2, position], axis=1)
+  position = np.broadcast_to(position, vec2.shape)
+  m = np.stack([vec0, vec1, vec2, position], axis=-1)
   return m
 
 
 def normalize(x):
-  """Normalization helper function."""
-  return x / np.linalg.norm(x)
+  """Normalization helper function, normalizes along the last axis."""
+  return x / np.linalg.norm(x, axis=-1, keepdims=True)
+
+
+def _spiral_offsets(radii, n_frames, n_rots, zrate):
+  """Returns the [n_frames, 4] homogeneous camera offsets along a spiral."""
+  thetas = np.linspace(0., 2. * np.pi * n_rots, n_frames, endpoint=False)
+  return radii * np.stack([
+      np.cos(thetas), -np.sin(thetas), -np.sin(thetas * zrate),
+      np.ones_like(thetas)
+  ], axis=-1)
 
 
 def generate_spiral_path(poses, bounds, n_frames=120, n_rots=2, zrate=.5):
@@ -187,21 +247,16 @@ def generate_spiral_path(poses, bounds, n_frames=120, n_rots=2, zrate=.5):
   focal = 1 / (((1 - dt) / close_depth + dt / inf_depth))
 
   # Get radii for spiral path using 90th percentile of camera positions.
-  positions = poses[:, :3, 3]
-  radii = np.percentile(np.abs(positions), 90, 0)
+  stats = _pose_stats(poses)
+  radii = np.percentile(np.abs(stats.positions), 90, 0)
   radii = np.concatenate([radii, [1.]])
 
   # Generate poses for spiral path.
-  render_poses = []
-  cam2world = poses_avg(poses)
-  up = poses[:, :3, 1].mean(0)
-  for theta in np.linspace(0., 2. * np.pi * n_rots, n_frames, endpoint=False):
-    t = radii * [np.cos(theta), -np.sin(theta), -np.sin(theta * zrate), 1.]
-    position = cam2world @ t
-    lookat = cam2world @ [0, 0, -focal, 1.]
-    z_axis = position - lookat
-    render_poses.append(viewmatrix(z_axis, up, position))
-  render_poses = np.stack(render_poses, axis=0)
+  cam2world = poses_avg(poses, stats)
+  up = stats.mean_up
+  positions = _spiral_offsets(radii, n_frames, n_rots, zrate) @ cam2world.T
+  lookat = cam2world @ [0, 0, -focal, 1.]
+  render_poses = viewmatrix(positions - lookat, up, positions)
   return render_poses
 
 
@@ -209,20 +264,16 @@ def generate_spiral_path_dtu(poses, n_frames=120, n_rots=2, zrate=.5, perc=60):
   """Calculates a forward facing spiral path for rendering for DTU."""
 
   # Get radii for spiral path using 60th percentile of camera positions.
-  positions = poses[:, :3, 3]
-  radii = np.percentile(np.abs(positions), perc, 0)
+  stats = _pose_stats(poses)
+  radii = np.percentile(np.abs(stats.positions), perc, 0)
   radii = np.concatenate([radii, [1.]])
 
   # Generate poses for spiral path.
-  render_poses = []
-  cam2world = poses_avg(poses)
-  up = poses[:, :3, 1].mean(0)
+  cam2world = poses_avg(poses, stats)
+  up = stats.mean_up
   z_axis = focus_pt_fn(poses)
-  for theta in np.linspace(0., 2. * np.pi * n_rots, n_frames, endpoint=False):
-    t = radii * [np.cos(theta), -np.sin(theta), -np.sin(theta * zrate), 1.]
-    position = cam2world @ t
-    render_poses.append(viewmatrix(z_axis, up, position, True))
-  render_poses = np.stack(render_poses, axis=0)
+  positions = _spiral_offsets(radii, n_frames, n_rots, zrate) @ cam2world.T
+  render_poses = viewmatrix(z_axis, up, positions, True)
   return render_poses
 
 
@@ -234,15 +285,14 @@ def generate_hemispherical_orbit(poses, n_frames=120):
   # Assume that z-axis points up towards approximate camera hemisphere
   sin_phi = np.mean(origins[:, 2], axis=0) / radius
   cos_phi = np.sqrt(1 - sin_phi**2)
-  render_poses = []
 
   up = np.array([0., 0., 1.])
-  for theta in np.linspace(0., 2. * np.pi, n_frames, endpoint=False):
-    camorigin = radius * np.array(
-        [cos_phi * np.cos(theta), cos_phi * np.sin(theta), sin_phi])
-    render_poses.append(viewmatrix(camorigin, up, camorigin))
-
-  render_poses = np.stack(render_poses, axis=0)
+  thetas = np.linspace(0., 2. * np.pi, n_frames, endpoint=False)
+  camorigins = radius * np.stack([
+      cos_phi * np.cos(thetas), cos_phi * np.sin(thetas),
+      np.full_like(thetas, sin_phi)
+  ], axis=-1)
+  render_poses = viewmatrix(camorigins, up, camorigins)
   return render_poses
 
 
@@ -251,14 +301,11 @@ def transform_poses_to_hemisphere(poses, bounds):
 
   # Use linear algebra to solve for the nearest point to the set of lines
   # given by each camera's focal axis
-  directions, origins = poses[:, :3, 2:3], poses[:, :3, 3:4]
-  m = np.eye(3) - directions * np.transpose(directions, [0, 2, 1])
-  mt_m = np.transpose(m, [0, 2, 1]) @ m
-  focus_pt = np.linalg.inv(mt_m.mean(0)) @ (mt_m @ origins).mean(0)[:, 0]
+  focus_pt = focus_pt_fn(poses)
 
   # Recenter poses around this point and such that the world space z-axis
   # points up toward the camera hemisphere (based on average camera origin)
-  toward_cameras = origins[Ellipsis, 0].mean(0) - focus_pt
+  toward_cameras = _pose_stats(poses).mean_position - focus_pt
   arbitrary_dir = np.array([.1, .2, .3])
   cam2world = viewmatrix(toward_cameras, arbitrary_dir, focus_pt)
   poses_recentered = np.linalg.inv(pad_poses(cam2world)) @ pad_poses(poses)
@@ -275,11 +322,315 @@ def transform_poses_to_hemisphere(poses, bounds):
   return poses_recentered, bounds_recentered
 
 
-def subsample_patches(images, patch_size, batch_size, batching='all_images'):
-  """Subsamples patches."""
+def _build_rays_kernel(camtoworlds, width, height, focal, pixel_offset,
+                       directions, viewdirs, radii):
+  """Fills pinhole ray directions, viewdirs and radii in a single pass."""
+  for n in numba.prange(camtoworlds.shape[0]):  # pylint: disable=not-an-iterable
+    r = camtoworlds[n]
+    for y in range(height):
+      cy = -(y - height * 0.5 + pixel_offset) / focal
+      for x in range(width):
+        cx = (x - width * 0.5 + pixel_offset) / focal
+        dx = r[0, 0] * cx + r[0, 1] * cy - r[0, 2]
+        dy = r[1, 0] * cx + r[1, 1] * cy - r[1, 2]
+        dz = r[2, 0] * cx + r[2, 1] * cy - r[2, 2]
+        directions[n, y, x, 0] = dx
+        directions[n, y, x, 1] = dy
+        directions[n, y, x, 2] = dz
+        inv_norm = 1. / np.sqrt(dx * dx + dy * dy + dz * dz)
+        viewdirs[n, y, x, 0] = dx * inv_norm
+        viewdirs[n, y, x, 1] = dy * inv_norm
+        viewdirs[n, y, x, 2] = dz * inv_norm
+    # Distance from each direction vector to its y-axis neighbor; the last row
+    # reuses the distance of the row above.
+    for y in range(height):
+      y0 = min(y, height - 2)
+      for x in range(width):
+        d = 0.
+        for c in range(3):
+          diff = directions[n, y0, x, c] - directions[n, y0 + 1, x, c]
+          d += diff * diff
+        radii[n, y, x, 0] = np.sqrt(d) * 2 / np.sqrt(12)
+
+
+if numba is not None:
+  _build_rays_kernel = numba.njit(parallel=True, fastmath=True, cache=True)(
+      _build_rays_kernel)
+
+
+@functools.lru_cache(maxsize=16)
+def _camera_dirs(width, height, focal, pixel_offset):
+  """Returns the read-only [H*W, 3] camera space pixel directions."""
+  x, y = np.meshgrid(  # pylint: disable=unbalanced-tuple-unpacking
+      np.arange(width, dtype=np.float32),  # X-Axis (columns)
+      np.arange(height, dtype=np.float32),  # Y-Axis (rows)
+      indexing='xy')
+  camera_dirs = np.stack(
+      [(x - width * 0.5 + pixel_offset) / focal,
+       -(y - height * 0.5 + pixel_offset) / focal, -np.ones_like(x)],
+      axis=-1).reshape(-1, 3)
+  camera_dirs.flags.writeable = False
+  return camera_dirs
+
+
+def _broadcast_scalar(x, shape, dtype=np.float32):
+  """Returns `x` as a read-only broadcast of `shape`, not a per-pixel array.
+
+  Used for the ray fields that are constant over the pixels of an image, e.g.
+  lossmult, near and far.
+  """
+  return np.broadcast_to(np.asarray(x, dtype), shape)
+
+
+def generate_pinhole_rays(camtoworlds, width, height, focal, near, far,
+                          pixel_offset=0.5, time=0.):
+  """Generates the rays of every pixel for a batch of pinhole cameras.
+
+  Args:
+    camtoworlds: np.ndarray, [N, 3 or 4, 4], camera to world matrices.
+    width: int, image width in pixels.
+    height: int, image height in pixels.
+    focal: float, focal length.
+    near: float, near plane.
+    far: float, far plane.
+    pixel_offset: float, offset added to the pixel index before centering.
+    time: float, timestamp of every ray, static scenes keep the default.
+
+  Returns:
+    rays: utils.Rays, every field is [N, height, width, C].
+  """
+  camtoworlds = np.ascontiguousarray(camtoworlds[:, :3, :4], dtype=np.float32)
+  shape = (camtoworlds.shape[0], height, width, 3)
+  if numba is not None:
+    directions = np.empty(shape, np.float32)
+    viewdirs = np.empty(shape, np.float32)
+    radii = np.empty(shape[:-1] + (1,), np.float32)
+    _build_rays_kernel(camtoworlds, width, height, float(focal),
+                       float(pixel_offset), directions, viewdirs, radii)
+  else:
+    # [H*W, 3] x [N, 3, 3] as one GEMM, without the [N, H, W, 3, 3] product.
+    directions = np.einsum('pk,nik->npi',
+                           _camera_dirs(width, height, float(focal),
+                                        float(pixel_offset)),
+                           camtoworlds[:, :3, :3],
+                           optimize=True).reshape(shape)
+    inv_norm = np.einsum('...i,...i->...', directions,
+                         directions)[Ellipsis, None]
+    np.reciprocal(np.sqrt(inv_norm, out=inv_norm), out=inv_norm)
+    viewdirs = directions * inv_norm
+
+    # Distance between the unnormalized directions of adjacent rows, written
+    # straight into `radii`; the last row repeats the one above.
+    diff = directions[:, 1:] - directions[:, :-1]
+    radii = np.empty(shape[:-1] + (1,), directions.dtype)
+    np.einsum('...i,...i->...', diff, diff, out=radii[:, :-1, :, 0])
+    np.sqrt(radii[:, :-1], out=radii[:, :-1])
+    # Cut the distance in half, multiply it to match the variance of a uniform
+    # distribution the size of a pixel (1/12, see paper).
+    radii[:, :-1] *= 2 / np.sqrt(12)
+    radii[:, -1] = radii[:, -2]
+
+  origins = np.broadcast_to(camtoworlds[:, None, None, :3, -1], shape)
+  return utils.Rays(
+      origins=origins,
+      directions=directions,
+      viewdirs=viewdirs,
+      radii=radii,
+      lossmult=_broadcast_scalar(1., radii.shape),
+      times=_broadcast_scalar(time, radii.shape),
+      near=_broadcast_scalar(near, radii.shape),
+      far=_broadcast_scalar(far, radii.shape))
+
+
+def _build_multicam_rays_kernel(pix2cam, cam2world, camera_dirs, directions,
+                                viewdirs, radii):
+  """Fills Multicam camera dirs, directions, viewdirs and radii in one pass."""
+  height, width = directions.shape[1], directions.shape[2]
+  for n in numba.prange(directions.shape[0]):  # pylint: disable=not-an-iterable
+    p, r = pix2cam[n], cam2world[n]
+    for y in range(height):
+      py = y + .5
+      for x in range(width):
+        px = x + .5
+        cx = p[0, 0] * px + p[0, 1] * py + p[0, 2]
+        cy = p[1, 0] * px + p[1, 1] * py + p[1, 2]
+        cz = p[2, 0] * px + p[2, 1] * py + p[2, 2]
+        camera_dirs[n, y, x, 0] = cx
+        camera_dirs[n, y, x, 1] = cy
+        camera_dirs[n, y, x, 2] = cz
+        # World directions are negated and mirrored along the columns.
+        xr = width - 1 - x
+        dx = -(r[0, 0] * cx + r[0, 1] * cy + r[0, 2] * cz)
+        dy = -(r[1, 0] * cx + r[1, 1] * cy + r[1, 2] * cz)
+        dz = -(r[2, 0] * cx + r[2, 1] * cy + r[2, 2] * cz)
+        directions[n, y, xr, 0] = dx
+        directions[n, y, xr, 1] = dy
+        directions[n, y, xr, 2] = dz
+        inv_norm = 1. / np.sqrt(dx * dx + dy * dy + dz * dz)
+        viewdirs[n, y, xr, 0] = dx * inv_norm
+        viewdirs[n, y, xr, 1] = dy * inv_norm
+        viewdirs[n, y, xr, 2] = dz * inv_norm
+    # Distance from each direction vector to its y-axis neighbor; the last row
+    # reuses the distance of the row above.
+    for y in range(height):
+      y0 = min(y, height - 2)
+      for x in range(width):
+        d = 0.
+        for c in range(3):
+          diff = directions[n, y0, x, c] - directions[n, y0 + 1, x, c]
+          d += diff * diff
+        radii[n, y, x, 0] = np.sqrt(d) * 2 / np.sqrt(12)
+
+
+if numba is not None:
+  _build_multicam_rays_kernel = numba.njit(
+      parallel=True, fastmath=True, cache=True)(_build_multicam_rays_kernel)
+
+
+@functools.lru_cache(maxsize=16)
+def _pixel_dirs(width, height):
+  """Returns the read-only [H, W, 3] homogeneous pixel centers of an image."""
+  x, y = np.meshgrid(  # pylint: disable=unbalanced-tuple-unpacking
+      np.arange(width, dtype=np.float32) + .5,  # X-Axis (columns)
+      np.arange(height, dtype=np.float32) + .5,  # Y-Axis (rows)
+      indexing='xy')
+  pixel_dirs = np.stack([x, y, np.ones_like(x)], axis=-1)
+  pixel_dirs.flags.writeable = False
+  return pixel_dirs
+
+
+def _resolution_groups(width, height):
+  """Maps each distinct (width, height) to the indices of its cameras."""
+  groups = collections.defaultdict(list)
+  for i, (w, h) in enumerate(zip(width, height)):
+    groups[int(w), int(h)].append(i)
+  return groups
+
+
+def _multicam_group_directions(pix2cam, width, height, cam2world=None):
+  """Computes the directions of Multicam cameras sharing one resolution.
+
+  Args:
+    pix2cam: np.ndarray, [G, 3, 3], pixel to camera matrices.
+    width: int, image width in pixels.
+    height: int, image height in pixels.
+    cam2world: np.ndarray, [G, 3 or 4, 4], camera to world matrices, or None
+      to only compute camera space directions.
+
+  Returns:
+    camera_dirs: np.ndarray, [G, H, W, 3], camera space directions.
+    directions: np.ndarray, [G, H, W, 3], world space directions, columns
+      reversed and negated as the Multicam rig expects, or None without
+      `cam2world`.
+  """
+  pixel_dirs = _pixel_dirs(width, height)
+  p2c_t = np.ascontiguousarray(pix2cam[:, :3, :3].transpose(0, 2, 1))
+  # [H, W, 3] x [G, 1, 3, 3] -> [G, H, W, 3] in one batched matmul.
+  camera_dirs = np.matmul(pixel_dirs, p2c_t[:, None])
+  if cam2world is None:
+    return camera_dirs, None
+  # Fold cam2world into pix2cam first, the cheap [G, 3, 3] contraction, so
+  # the world directions are one more matmul of the small pixel grid rather
+  # than a second pass over `camera_dirs`.
+  p2w_t = np.matmul(p2c_t, cam2world[:, :3, :3].transpose(0, 2, 1))
+  directions = -np.matmul(pixel_dirs, p2w_t[:, None])[:, :, ::-1]
+  return camera_dirs, directions
+
+
+def _multicam_rays(pix2cam, cam2world, width, height):
+  """Generates the per-pixel Multicam ray fields of every camera.
+
+  Args:
+    pix2cam: np.ndarray, [N, 3, 3], pixel to camera matrices.
+    cam2world: np.ndarray, [N, 3 or 4, 4], camera to world matrices.
+    width: np.ndarray, [N], image widths in pixels.
+    height: np.ndarray, [N], image heights in pixels.
+
+  Returns:
+    camera_dirs, directions, viewdirs, radii: lists of N [H, W, C] arrays.
+  """
+  pix2cam = np.asarray(pix2cam, np.float32)
+  cam2world = np.asarray(cam2world, np.float32)
+  n = len(width)
+  camera_dirs, directions, viewdirs, radii = ([None] * n for _ in range(4))
+  for (w, h), idx in _resolution_groups(width, height).items():
+    if numba is None:
+      cam, world = _multicam_group_directions(pix2cam[idx], w, h,
+                                              cam2world[idx])
+      inv_norm = np.einsum('...i,...i->...', world, world)[Ellipsis, None]
+      np.reciprocal(np.sqrt(inv_norm, out=inv_norm), out=inv_norm)
+      view = world * inv_norm
+      # Distance between the unnormalized directions of adjacent rows, in one
+      # pass over the group; the last row repeats the one above.
+      dx = np.linalg.norm(np.diff(world, axis=1), axis=-1)
+      dx = np.pad(dx, ((0, 0), (0, 1), (0, 0)), mode='edge')
+      # Cut the distance in half, and then round it out so that it's
+      # halfway between inscribed by / circumscribed about the pixel.
+      group = (cam, world, view, dx[Ellipsis, None] * 2 / np.sqrt(12))
+    else:
+      shape = (len(idx), h, w, 3)
+      group = (np.empty(shape, np.float32), np.empty(shape, np.float32),
+               np.empty(shape, np.float32),
+               np.empty(shape[:-1] + (1,), np.float32))
+      _build_multicam_rays_kernel(
+          np.ascontiguousarray(pix2cam[idx, :3, :3]),
+          np.ascontiguousarray(cam2world[idx, :3, :3]), *group)
+    for j, i in enumerate(idx):
+      camera_dirs[i], directions[i], viewdirs[i], radii[i] = (
+          x[j] for x in group)
+  return camera_dirs, directions, viewdirs, radii
+
+
+@functools.partial(jax.jit, static_argnums=(2, 3))
+def _multicam_random_rays(pix2cam, camtoworlds, width, height):
+  """Computes the per-pixel fields of Multicam random rays in one XLA program.
+
+  Args:
+    pix2cam: [P, 3, 3], pixel to camera matrix of the camera of each pose.
+    camtoworlds: [P, 3, 3], rotations of the random poses.
+    width: int, image width shared by every camera.
+    height: int, image height shared by every camera.
+
+  Returns:
+    directions, viewdirs, radii: [P, H, W, C], one image per random pose.
+  """
+  # Fold every random pose into its pix2cam, [P, 3, 3], so that
+  # [H*W, 3] x [P, 3, 3] -> [P, H, W, 3] is one batched GEMM with no camera
+  # space directions in between.
+  p2w_t = jnp.matmul(jnp.swapaxes(pix2cam, -1, -2),
+                     jnp.swapaxes(camtoworlds, -1, -2))
+  directions = jnp.matmul(_pixel_dirs(width, height).reshape(-1, 3), p2w_t)
+  directions = directions.reshape((-1, height, width, 3))
+  viewdirs = directions / jnp.linalg.norm(directions, axis=-1, keepdims=True)
+  # Distance between the unnormalized directions of adjacent rows within the
+  # same camera image; the last row repeats the one above.
+  dx = jnp.linalg.norm(jnp.diff(directions, axis=1), axis=-1)
+  dx = jnp.concatenate([dx, dx[:, -1:]], axis=1)
+  # Cut the distance in half, and then round it out so that it's
+  # halfway between inscribed by / circumscribed about the pixel.
+  radii = dx[Ellipsis, None] * 2 / np.sqrt(12)
+  return directions, viewdirs, radii
+
+
+def patch_offsets(patch_size):
+  """Returns the [1, patch_size**2, 2] (x, y) pixel offsets within a patch."""
+  return np.stack(
+      np.meshgrid(np.arange(patch_size), np.arange(patch_size), indexing='xy'),
+      axis=-1).reshape(1, -1, 2)
+
+
+def subsample_patches(images, patch_size, batch_size, rng,
+                      batching='all_images', offsets=None):
+  """Subsamples patches.
+
+  `rng` is the np.random.Generator to draw from and `offsets` optionally
+  caches `patch_offsets(patch_size)`.
+  """
   n_patches = batch_size // (patch_size ** 2)
+  if offsets is None:
+    offsets = patch_offsets(patch_size)
 
-  scale = np.random.randint(0, len(images))
+  scale = rng.integers(0, len(images))
   images = images[scale]
 
   if isinstance(images, np.ndarray):
@@ -287,33 +638,113 @@ def subsample_patches(images, patch_size, batch_size, batching='all_images'):
   else:
     shape = images.origins.shape
 
-  # Sample images
+  if batching not in ('all_images', 'single_image'):
+    raise ValueError('Not supported batching type!')
+  # Sample images and start locations in one draw.
+  samples = rng.integers(
+      0, [shape[0], shape[2] - patch_size + 1, shape[1] - patch_size + 1],
+      size=(n_patches, 3))
   if batching == 'all_images':
-    idx_img = np.random.randint(0, shape[0], size=(n_patches, 1))
-  elif batching == 'single_image':
-    idx_img = np.random.randint(0, shape[0])
-    idx_img = np.full((n_patches, 1), idx_img, dtype=int)
+    idx_img = samples[:, :1]
   else:
-    raise ValueError('Not supported batching type!')
-
-  # Sample start locations
-  x0 = np.random.randint(0, shape[2] - patch_size + 1, size=(n_patches, 1, 1))
-  y0 = np.random.randint(0, shape[1] - patch_size + 1, size=(n_patches, 1, 1))
-  xy0 = np.concatenate([x0, y0], axis=-1)
-  patch_idx = xy0 + np.stack(
-      np.meshgrid(np.arange(patch_size), np.arange(patch_size), indexing='xy'),
-      axis=-1).reshape(1, -1, 2)
+    idx_img = np.full((n_patches, 1), samples[0, 0])
+  xx = samples[:, 1:2] + offsets[Ellipsis, 0]
+  yy = samples[:, 2:3] + offsets[Ellipsis, 1]
 
   # Subsample images
   if isinstance(images, np.ndarray):
-    out = images[idx_img, patch_idx[Ellipsis, 1], patch_idx[Ellipsis, 0]].reshape(-1, 3)
+    out = images[idx_img, yy, xx].reshape(-1, 3)
   else:
     out = utils.dataclass_map(
-        lambda x: x[idx_img, patch_idx[Ellipsis, 1], patch_idx[Ellipsis, 0]].reshape(  # pylint: disable=g-long-lambda
-            -1, x.shape[-1]), images)
+        lambda x: x[idx_img, yy, xx].reshape(-1, x.shape[-1]), images)
   return out, np.ones((n_patches, 1), dtype=np.float32) * scale
 
 
+def cast_rays(rays, dtype, radii_dtype=None):
+  """Casts every field of `rays` to `dtype`, a no-op for matching fields.
+
+  Broadcast fields stay broadcasts, only the values they repeat are cast.
+  `radii_dtype`, if given, overrides `dtype` for the radii.
+  """
+  def cast(x, dtype):
+    if x.dtype == dtype or 0 not in x.strides:
+      return x.astype(dtype, copy=False)
+    values = x[tuple(slice(None) if st else slice(1) for st in x.strides)]
+    return np.broadcast_to(values.astype(dtype), x.shape)
+  fields = {k: cast(v, dtype) for k, v in vars(rays).items()}
+  if radii_dtype is not None:
+    fields['radii'] = cast(rays.radii, radii_dtype)
+  return utils.Rays(**fields)
+
+
+def pack_rays(rays, exclude=(), dtype=None):
+  """Packs every field of `rays` into one contiguous [..., C] array.
+
+  Args:
+    rays: utils.Rays, all fields share every dimension but the last.
+    exclude: names of fields to leave out of the packed array.
+    dtype: dtype of the packed array, by default the promoted field dtype.
+
+  Returns:
+    packed: np.ndarray, [..., C], the fields concatenated along the last axis.
+    layout: dict, the slice of the last axis holding each field.
+  """
+  fields = {k: v for k, v in vars(rays).items() if k not in exclude}
+  layout, start = {}, 0
+  for k, v in fields.items():
+    layout[k] = slice(start, start + v.shape[-1])
+    start += v.shape[-1]
+  packed = np.concatenate(
+      [v.astype(dtype, copy=False) if dtype else v for v in fields.values()],
+      axis=-1)
+  return packed, layout
+
+
+def unpack_rays(packed, layout, **fields):
+  """Returns a utils.Rays of views into an array made by `pack_rays`.
+
+  Fields excluded from the packed array are passed as keyword arguments.
+  """
+  return utils.Rays(
+      **{k: packed[Ellipsis, s] for k, s in layout.items()}, **fields)
+
+
+@functools.partial(jax.jit, static_argnums=(0, 1))
+def _sample_batch(batch_size, rgb_dtype, images, rays_packed, per_image, key):
+  """Samples `batch_size` flattened rays and their colors on device.
+
+  `rays_packed` and `images` hold the rays of every image back to back, while
+  `per_image` maps the remaining ray fields to one [n_images, C] value each.
+  uint8 colors are dequantized to `rgb_dtype`.
+  """
+  ray_indices = jax.random.randint(key, (batch_size,), 0, images.shape[0])
+  rgb = images_to_float(jnp.take(images, ray_indices, axis=0), rgb_dtype)
+  rays = jnp.take(rays_packed, ray_indices, axis=0)
+  n_images = jax.tree_leaves(per_image)[0].shape[0]
+  image_indices = ray_indices // (images.shape[0] // n_images)
+  per_image = jax.tree_map(lambda v: jnp.take(v, image_indices, axis=0),
+                           per_image)
+  return rgb, rays, per_image, ray_indices
+
+
+def quantize_images(images):
+  """Quantizes float images in [0, 1] to uint8, uint8 images pass through."""
+  if images.dtype == np.uint8:
+    return images
+  return (np.clip(images, 0., 1.) * 255. + .5).astype(np.uint8)
+
+
+def images_to_float(images, dtype=np.float32):
+  """Dequantizes uint8 colors to `dtype` in [0, 1], float colors pass through.
+
+  Works on NumPy and JAX arrays, batches are dequantized after sampling so the
+  stored images stay uint8.
+  """
+  if images.dtype != np.uint8:
+    return images
+  return images.astype(dtype) * np.asarray(1. / 255., dtype)
+
+
 def anneal_nearfar(d, it, near_final, far_final,
                    n_steps=2000, init_perc=0.2, mid_perc=0.5):
   """Anneals near and far plane."""
@@ -330,26 +761,32 @@ def anneal_nearfar(d, it, near_final, far_final,
   out_dict = {}
   for (k, v) in d.items():
     if 'rays' in k and isinstance(v, utils.Rays):
-      ones = np.ones_like(v.origins[Ellipsis, :1])
+      # Read-only broadcasts of the scalars, nothing batch-sized is allocated.
+      shape, dtype = v.origins[Ellipsis, :1].shape, v.origins.dtype
       rays_out = utils.Rays(
           origins=v.origins, directions=v.directions,
           viewdirs=v.viewdirs, radii=v.radii,
           times = v.times,
-          lossmult=v.lossmult, near=ones*near_i, far=ones*far_i)
+          lossmult=v.lossmult,
+          near=_broadcast_scalar(near_i, shape, dtype),
+          far=_broadcast_scalar(far_i, shape, dtype))
       out_dict[k] = rays_out
     else:
       out_dict[k] = v
   return out_dict
 
 
-def sample_recon_scale(image_list, dist='uniform_scale'):
-  """Samples a scale factor for the reconstruction loss."""
+def sample_recon_scale(image_list, rng, dist='uniform_scale'):
+  """Samples a scale factor for the reconstruction loss.
+
+  `rng` is the np.random.Generator to draw from.
+  """
   if dist == 'uniform_scale':
-    idx = np.random.randint(len(image_list))
+    idx = rng.integers(len(image_list))
   elif dist == 'uniform_size':
     n_img = np.array([i.shape[0] for i in image_list], dtype=np.float32)
     probs = n_img / np.sum(n_img)
-    idx = np.random.choice(np.arange(len(image_list)), size=(), p=probs)
+    idx = rng.choice(len(image_list), p=probs)
   return idx
 
 
@@ -362,7 +799,8 @@ class Dataset(threading.Thread):
 
     # here are the variables that added for the video dataset
     self.time_frame_num = 0
-    self.queue = queue.Queue(3)  # Set prefetch buffer to 3 batches.
+    # Prefetch at least 3 batches.
+    self.queue = queue.Queue(max(3, config.prefetch_depth))
     self.daemon = True
     self._path_videodir = config.video_dir
     self.start_frame = config.start_frame
@@ -380,6 +818,8 @@ class Dataset(threading.Thread):
                        and (not config.dtu_no_mask_eval)
                        and (not config.render_path))
     self.checkpointdir = config.checkpoint_dir
+    self.debug_dump = config.debug_dump
+    self.ray_cache_dir = config.ray_cache_dir
 
     self.split = split
     if config.dataset_loader == 'dtu':
@@ -400,7 +840,27 @@ class Dataset(threading.Thread):
     self.anneal_nearfar_perc = config.anneal_nearfar_perc
     self.anneal_mid_perc = config.anneal_mid_perc
     self.sample_reconscale_dist = config.sample_reconscale_dist
-
+    # Rays are computed in float32 and only stored in this dtype.
+    self.ray_dtype = _RAY_DTYPES[config.ray_dtype]
+    self.radii_dtype = (_RAY_DTYPES[config.radii_dtype]
+                        if config.radii_dtype else None)
+    # Training rays are packed in ray_dtype by `_pack_train_rays`, rounding
+    # their radii to radii_dtype first would only lose precision.
+    self.image_radii_dtype = None if split == 'train' else self.radii_dtype
+    self.uint8_images = config.uint8_images
+    # uint8 colors are dequantized in bfloat16 when the rays are stored in it,
+    # in float32 otherwise.
+    self.rgb_dtype = (self.ray_dtype if config.ray_dtype == 'bfloat16' else
+                      np.float32)
+
+    # The dataset's generator, drawn from np.random here so it follows the
+    # seeding of the main thread. __init__ uses it before the data thread
+    # starts, which is then its only user.
+    self._rng = np.random.default_rng(np.random.randint(2**31))
+    self.device_sampling = (split == 'train' and config.device_sampling and
+                            config.batching == 'all_images')
+
+    self.rays_packed = None
     if split == 'train':
       self._train_init(config)
     elif split == 'test' or split == 'path':
@@ -412,6 +872,14 @@ class Dataset(threading.Thread):
     self.batch_size_random = config.batch_size_random // jax.host_count()
     print('Using following batch size', self.batch_size)
     self.patch_size = config.patch_size
+    self._patch_offsets = patch_offsets(self.patch_size)
+    if self.device_sampling:
+      # Upload every scale once, batches are then sampled by `_sample_batch`.
+      self.images_device = self._device_images()
+      self.rays_device = [jax.device_put(r) for r in self.rays_packed]
+      self.ray_per_image_device = [
+          jax.device_put(d) for d in self.ray_per_image]
+      self.sample_key = jax.random.PRNGKey(np.random.randint(2**31))
     self.batching = config.batching
     self.batching_random = config.batching_random
     self.render_path = config.render_path
@@ -428,11 +896,7 @@ class Dataset(threading.Thread):
     Returns:
       batch: dict, has 'rgb' and 'rays'.
     """
-    x = self.queue.get()
-    if self.split == 'train':
-      return utils.shard(x)
-    else:
-      return utils.to_device(x)
+    return self.queue.get()
 
   def peek(self):
     """Peek at the next training batch or test example without dequeuing it.
@@ -440,17 +904,17 @@ class Dataset(threading.Thread):
     Returns:
       batch: dict, has 'rgb' and 'rays'.
     """
-    x = self.queue.queue[0].copy()  # Make a copy of the front of the queue.
-    if self.split == 'train':
-      return utils.shard(x)
-    else:
-      return utils.to_device(x)
+    return self.queue.queue[0].copy()  # Make a copy of the front of the queue.
 
   def run(self):
+    # Batches are sharded or moved to device here, so that happens while the
+    # main thread trains on the previous batch.
     if self.split == 'train':
-      next_func = self._next_train
+      # Sampling only draws from the dataset's own generator, never the global
+      # (locked) np.random state.
+      next_func = lambda: utils.shard(self._next_train(self._rng))
     else:
-      next_func = self._next_test
+      next_func = lambda: utils.to_device(self._next_test())
     while True:
       self.queue.put(next_func())
       # print("Queue size", self.queue.qsize())
@@ -459,6 +923,73 @@ class Dataset(threading.Thread):
   def size(self):
     return self.n_examples
 
+  def _device_images(self):
+    """Returns the flattened training images of every scale on device."""
+    return [jax.device_put(i) for i in self.images]
+
+  def _debug_dump(self, name, obj):
+    """Writes `str(obj)` to `checkpoint_dir/debug/name` if `debug_dump` is set."""
+    if not self.debug_dump:
+      return
+    debug_dir = os.path.join(self.checkpointdir, 'debug')
+    os.makedirs(debug_dir, exist_ok=True)
+    with open(os.path.join(debug_dir, name), 'w') as f:
+      f.write(str(obj))
+
+  def _cached_arrays(self, name, generate, *key):
+    """Returns the dict of arrays built by `generate()`, cached on disk.
+
+    With `ray_cache_dir` set, each array is saved as its own .npy file in a
+    directory named after `name` and a hash of `key`, the inputs the arrays
+    are derived from, and of `_RAY_CACHE_VERSION`. Later runs memory map those
+    files instead of calling `generate` again.
+
+    Args:
+      name: str, prefix of the cache directory.
+      generate: callable returning a dict of np.ndarrays.
+      *key: np.ndarrays or scalars that determine the output of `generate`.
+
+    Returns:
+      A dict of np.ndarrays, read-only memory maps on a cache hit.
+    """
+    if not self.ray_cache_dir:
+      return generate()
+    digest = hashlib.sha1(repr(_RAY_CACHE_VERSION).encode())
+    for k in key:
+      k = np.asarray(k)
+      digest.update(repr((k.dtype.str, k.shape)).encode())
+      digest.update(np.ascontiguousarray(k).tobytes())
+    cache_dir = os.path.join(self.ray_cache_dir,
+                             f'{name}-{digest.hexdigest()}')
+    if path.isdir(cache_dir):
+      return {
+          f[:-len('.npy')]: np.load(path.join(cache_dir, f), mmap_mode='r')
+          for f in os.listdir(cache_dir)
+      }
+    arrays = generate()
+    # Write into a private directory first so an interrupted run never
+    # leaves a partial cache behind.
+    tmp_dir = f'{cache_dir}.tmp{os.getpid()}'
+    os.makedirs(tmp_dir, exist_ok=True)
+    for k, v in arrays.items():
+      np.save(path.join(tmp_dir, k + '.npy'), v)
+    try:
+      os.replace(tmp_dir, cache_dir)
+    except OSError:
+      shutil.rmtree(tmp_dir)  # Another process filled the cache first.
+    return arrays
+
+  def _multicam_ray_fields(self, pix2cam, cam2world, width, height):
+    """Returns the stacked `_multicam_rays` fields, through the ray cache."""
+    def generate():
+      fields = _multicam_rays(pix2cam, cam2world, width, height)
+      return {
+          k: np.stack(x, axis=0) for k, x in zip(
+              ('camera_dirs', 'directions', 'viewdirs', 'radii'), fields)
+      }
+    return self._cached_arrays('multicam_rays', generate, pix2cam, cam2world,
+                               width, height)
+
   def _train_init(self, config):
     """Initialize training."""
     self._load_renderings(config)
@@ -484,12 +1015,6 @@ class Dataset(threading.Thread):
       if self.load_normals:
         self.normal_images = self.normal_images.reshape([-1, 3])
 
-      self.ray_noreshape = [self.rays]
-      self.rays = [utils.dataclass_map(lambda r: r.reshape(  # pylint: disable=g-long-lambda
-          [-1, r.shape[-1]]), i) for (i, res) in zip(
-              self.rays, self.resolutions)]
-
-  
     elif config.batching == 'single_image':
       print("image shape:",self.images_noreshape.shape)
       self.images = [i.reshape(
@@ -500,20 +1025,62 @@ class Dataset(threading.Thread):
       if self.load_normals:
         self.normal_images = self.normal_images.reshape(
             [-1, self.resolution, 3])
-      
-      self.ray_noreshape = [self.rays]
-      # print("rays:",self.rays)    
-      self.rays = [utils.dataclass_map(lambda r: r.reshape(  # pylint: disable=g-long-lambda
-          [-1, res, r.shape[-1]]), i) for (i, res) in  # pylint: disable=cell-var-from-loop
-                   zip(self.rays, self.resolutions)]
       print("self.resolutions:", self.resolutions)
-      # print("rays:",self.rays)   
     else:
       raise NotImplementedError(
           f'{config.batching} batching strategy is not implemented.')
-    # print("rays:",self.rays)
-    with open('/media/pleasework/Storage/regnerf/New_Dev/debug/pop-dict.txt', 'w') as f:
-      f.write(str(self.rays))
+    if self.uint8_images:
+      self.images = [quantize_images(i) for i in self.images]
+
+    self._pack_train_rays(config)
+
+  def _pack_train_rays(self, config):
+    """Packs `self.rays`, one [N, H, W, C] Rays per scale, for training."""
+    # Pack the per-pixel fields of each scale into one buffer so a batch of
+    # rays is a single gather. Fields broadcast over the pixels of an image
+    # (origins, near, far, ...) keep one value per image instead, and
+    # `_gather_rays` expands them per ray.
+    per_image = [k for k, v in vars(self.rays[0]).items()
+                 if v.strides[1] == v.strides[2] == 0]
+    self.ray_per_image = [
+        {k: np.ascontiguousarray(getattr(r, k)[:, 0, 0]) for k in per_image}
+        for r in self.rays]
+    packed = [pack_rays(r, exclude=per_image, dtype=self.ray_dtype)
+              for r in self.rays]
+    self.ray_layout = packed[0][1]
+    if config.batching == 'all_images':
+      # flatten the ray and image dimension together.
+      self.rays_packed = [p.reshape([-1, p.shape[-1]]) for p, _ in packed]
+    else:
+      self.rays_packed = [p.reshape([-1, res, p.shape[-1]])
+                          for (p, _), res in zip(packed, self.resolutions)]
+    # The training rays only live in the packed buffers from here on.
+    self.rays = None
+    self._debug_dump('pop-dict.txt', self.rays_packed)
+
+  def _gather_rays(self, scale, ray_indices, image_index=None):
+    """Gathers training rays from the packed buffers of `scale`.
+
+    Args:
+      scale: int, index of the reconstruction scale.
+      ray_indices: np.ndarray(int), [batch_size], the rays to gather.
+      image_index: int, the image the rays are from for 'single_image'
+        batching, None if the rays of all images are flattened together.
+
+    Returns:
+      rays: utils.Rays, views into the gathered [batch_size, C] buffer.
+    """
+    if image_index is None:
+      gathered = self.rays_packed[scale][ray_indices]
+      image_indices = ray_indices // self.resolutions[scale]
+      per_image = {k: v[image_indices]
+                   for k, v in self.ray_per_image[scale].items()}
+    else:
+      gathered = self.rays_packed[scale][image_index, ray_indices]
+      per_image = {
+          k: np.broadcast_to(v[image_index], (len(ray_indices), v.shape[-1]))
+          for k, v in self.ray_per_image[scale].items()}
+    return unpack_rays(gathered, self.ray_layout, **per_image)
 
   def _test_init(self, config):
     self._load_renderings(config)
@@ -522,37 +1089,48 @@ class Dataset(threading.Thread):
     self._generate_rays(config)
     self.it = 0
 
-  def _next_train(self):
-    """Sample next training batch."""
+  def _next_train(self, rng):
+    """Sample next training batch using the np.random.Generator `rng`."""
 
     self.it = self.it + 1
     # print("self.it:",self.it)
     return_dict = {}
     if self.batching == 'all_images':
       # sample scale
-      idxs = sample_recon_scale(self.images, self.sample_reconscale_dist)
-      ray_indices = np.random.randint(0, self.rays[idxs].origins.shape[0],
-                                      (self.batch_size,))
-      return_dict['rgb'] = self.images[idxs][ray_indices]
-      return_dict['rays'] = utils.dataclass_map(lambda r: r[ray_indices],
-                                                self.rays[idxs])
+      idxs = sample_recon_scale(self.images, rng,
+                                self.sample_reconscale_dist)
+      if self.device_sampling:
+        self.sample_key, key = jax.random.split(self.sample_key)
+        return_dict['rgb'], rays, per_image, ray_indices = _sample_batch(
+            self.batch_size, self.rgb_dtype, self.images_device[idxs],
+            self.rays_device[idxs], self.ray_per_image_device[idxs], key)
+        return_dict['rays'] = unpack_rays(rays, self.ray_layout, **per_image)
+        if self.load_disps or self.load_normals:
+          ray_indices = np.asarray(ray_indices)
+      else:
+        ray_indices = rng.integers(0, self.rays_packed[idxs].shape[0],
+                                   (self.batch_size,))
+        return_dict['rgb'] = images_to_float(self.images[idxs][ray_indices],
+                                             self.rgb_dtype)
+        return_dict['rays'] = self._gather_rays(idxs, ray_indices)
       if self.load_disps:
         return_dict['disps'] = self.disp_images[ray_indices]
       if self.load_normals:
         return_dict['normals'] = self.normal_images[ray_indices]
 
     elif self.batching == 'single_image':
-      idxs = sample_recon_scale(self.images, self.sample_reconscale_dist)
+      idxs = sample_recon_scale(self.images, rng,
+                                self.sample_reconscale_dist)
       idxs = 0
       # print("idxs:",idxs)
-      image_index = np.random.randint(0, self.n_examples, ())
-      ray_indices = np.random.randint(0, self.rays[idxs].origins[0].shape[0],
-                                      (self.batch_size,))
+      image_index = rng.integers(0, self.n_examples)
+      ray_indices = rng.integers(0, self.rays_packed[idxs].shape[1],
+                                 (self.batch_size,))
       # print("ray_indices:", ray_indices)
       # print("image index:", image_index)
-      return_dict['rgb'] = self.images[idxs][image_index][ray_indices]
-      return_dict['rays'] = utils.dataclass_map(
-          lambda r: r[image_index][ray_indices], self.rays[idxs])
+      return_dict['rgb'] = images_to_float(
+          self.images[idxs][image_index][ray_indices], self.rgb_dtype)
+      return_dict['rays'] = self._gather_rays(idxs, ray_indices, image_index)
       if self.load_disps:
         return_dict['disps'] = self.disp_images[image_index][ray_indices]
       if self.load_normals:
@@ -564,18 +1142,19 @@ class Dataset(threading.Thread):
     if self.load_random_rays:
       return_dict['rays_random'], return_dict['rays_random_scale'] = (
           subsample_patches(self.random_rays, self.patch_size,
-                            self.batch_size_random,
-                            batching=self.batching_random))
+                            self.batch_size_random, rng,
+                            batching=self.batching_random,
+                            offsets=self._patch_offsets))
       return_dict['rays_random2'], return_dict['rays_random2_scale'] = (
           subsample_patches(
-              self.random_rays, self.patch_size, self.batch_size_random,
-              batching=self.batching_random))
+              self.random_rays, self.patch_size, self.batch_size_random, rng,
+              batching=self.batching_random, offsets=self._patch_offsets))
     if self.load_random_fullimage_rays:
-      idx_img = np.random.randint(self.random_fullimage_rays.origins.shape[0])
+      idx_img = rng.integers(self.random_fullimage_rays.origins.shape[0])
       return_dict['rays_feat'] = utils.dataclass_map(
           lambda x: x[idx_img].reshape(-1, x.shape[-1]),
           self.random_fullimage_rays)
-      idx_img = np.random.randint(self.images_feat.shape[0])
+      idx_img = rng.integers(self.images_feat.shape[0])
       return_dict['image_feat'] = self.images_feat[idx_img].reshape(-1, 3)
 
     if self.anneal_nearfar:
@@ -583,9 +1162,7 @@ class Dataset(threading.Thread):
                                    self.anneal_nearfar_steps,
                                    self.anneal_nearfar_perc,
                                    self.anneal_mid_perc)
-    
-    with open('/home/pleasework/Desktop/Neural-motion-capture/debug/dan-dict-random-rays.txt', 'w') as f:
-      f.write(str(return_dict))
+    self._debug_dump('dan-dict-random-rays.txt', return_dict)
 
     return return_dict
 
@@ -618,41 +1195,12 @@ class Dataset(threading.Thread):
     print("using the generate rays from dataset classsssssssss")
     """Generating rays for all images."""
     del config  # Unused.
-    x, y = np.meshgrid(  # pylint: disable=unbalanced-tuple-unpacking
-        np.arange(self.width, dtype=np.float32),  # X-Axis (columns)
-        np.arange(self.height, dtype=np.float32),  # Y-Axis (rows)
-        indexing='xy')
-    camera_dirs = np.stack(
-        [(x - self.width * 0.5 + 0.5) / self.focal,
-         -(y - self.height * 0.5 + 0.5) / self.focal, -np.ones_like(x)],
-        axis=-1)
-    directions = ((camera_dirs[None, Ellipsis, None, :] *
-                   self.camtoworlds[:, None, None, :3, :3]).sum(axis=-1))
-    origins = np.broadcast_to(self.camtoworlds[:, None, None, :3, -1],
-                              directions.shape)
-    viewdirs = directions / np.linalg.norm(directions, axis=-1, keepdims=True)
-
-    # Distance from each unit-norm direction vector to its x-axis neighbor.
-    dx = np.sqrt(
-        np.sum((directions[:, :-1, :, :] - directions[:, 1:, :, :])**2, -1))
-    dx = np.concatenate([dx, dx[:, -2:-1, :]], axis=1)
-    # Cut the distance in half, multiply it to match the variance of a uniform
-    # distribution the size of a pixel (1/12, see paper).
-    radii = dx[Ellipsis, None] * 2 / np.sqrt(12)
-
-    ones = np.ones_like(origins[Ellipsis, :1])
-    self.rays = utils.Rays(
-        origins=origins,
-        directions=directions,
-        viewdirs=viewdirs,
-        lossmult=ones,
-        radii=radii,
-        near=ones * self.near,
-        far=ones * self.far)
+    self.rays = cast_rays(
+        generate_pinhole_rays(self.camtoworlds, self.width, self.height,
+                              self.focal, self.near, self.far),
+        self.ray_dtype, self.image_radii_dtype)
     self.render_rays = self.rays
-
-    with open('/home/pleasework/Desktop/Neural-motion-capture/debug/regnerf-rays.txt', 'w') as f:
-      f.write(str(self.rays))
+    self._debug_dump('regnerf-rays.txt', self.rays)
 
   def _generate_random_poses(self, config):
     """Generates random poses."""
@@ -700,51 +1248,31 @@ class Dataset(threading.Thread):
     random_rays = []
     for sfactor in [2**i for i in range(config.random_scales_init,
                                         config.random_scales)]:
-      w = self.width // sfactor
-      h = self.height // sfactor
-      f = self.focal / (sfactor * 1.0)
-      x, y = np.meshgrid(  # pylint: disable=unbalanced-tuple-unpacking
-          np.arange(w, dtype=np.float32),  # X-Axis (columns)
-          np.arange(h, dtype=np.float32),  # Y-Axis (rows)
-          indexing='xy')
-      camera_dirs = np.stack(
-          [(x - w * 0.5 + 0.5) / f,
-           -(y - h * 0.5 + 0.5) / f, -np.ones_like(x)],
-          axis=-1)
-      directions = ((camera_dirs[None, Ellipsis, None, :] *
-                     self.random_poses[:, None, None, :3, :3]).sum(axis=-1))
-      origins = np.broadcast_to(self.random_poses[:, None, None, :3, -1],
-                                directions.shape)
-      viewdirs = directions / np.linalg.norm(directions, axis=-1, keepdims=True)
-
-      # Distance from each unit-norm direction vector to its x-axis neighbor.
-      dx = np.sqrt(
-          np.sum((directions[:, :-1, :, :] - directions[:, 1:, :, :])**2, -1))
-      dx = np.concatenate([dx, dx[:, -2:-1, :]], axis=1)
-      # Cut the distance in half, multiply it to match the variance of a uniform
-      # distribution the size of a pixel (1/12, see paper).
-      radii = dx[Ellipsis, None] * 2 / np.sqrt(12)
-
-      ones = np.ones_like(origins[Ellipsis, :1])
-      rays = utils.Rays(
-          origins=origins,
-          directions=directions,
-          viewdirs=viewdirs,
-          radii=radii,
-          lossmult=ones,
-          near=ones * self.near,
-          far=ones * self.far)
-      random_rays.append(rays)
+      rays = generate_pinhole_rays(self.random_poses,
+                                   self.width // sfactor,
+                                   self.height // sfactor,
+                                   self.focal / (sfactor * 1.0), self.near,
+                                   self.far)
+      random_rays.append(cast_rays(rays, self.ray_dtype, self.radii_dtype))
     self.random_rays = random_rays
 
   def _load_renderings_featloss(self, config):
     """Loades renderings for DietNeRF's feature loss."""
     images = self.images[0]
     res = config.dietnerf_loss_resolution
-    images_feat = []
-    for img in images:
-      images_feat.append(cv2.resize(img, (res, res), cv2.INTER_AREA))
-    self.images_feat = np.stack(images_feat)
+    n, height, width = images.shape[:3]
+    fy, fx = height // res, width // res
+    if fy * res == height and fx * res == width:
+      # Area downsampling by an integer factor is a plain block mean.
+      self.images_feat = images.reshape(n, res, fy, res, fx, -1).mean(
+          axis=(2, 4), dtype=np.float32)
+    else:
+      self.images_feat = np.empty((n, res, res) + images.shape[3:],
+                                  np.float32)
+      resize = functools.partial(cv2.resize, dsize=(res, res),
+                                 interpolation=cv2.INTER_AREA)
+      for out, img in zip(self.images_feat, _thread_map(resize, images)):
+        out[:] = img
 
   def _generate_random_fullimage_rays(self, config):
     """Generating random rays for full images."""
@@ -754,47 +1282,25 @@ class Dataset(threading.Thread):
     height = config.dietnerf_loss_resolution
     f = self.focal / (self.width * 1.0 / width)
 
-    x, y = np.meshgrid(  # pylint: disable=unbalanced-tuple-unpacking
-        np.arange(width, dtype=np.float32) + .5,
-        np.arange(height, dtype=np.float32) + .5,
-        indexing='xy')
-
-    camera_dirs = np.stack([(x - width * 0.5 + 0.5) / f,
-                            -(y - height * 0.5 + 0.5) / f,
-                            -np.ones_like(x)], axis=-1)
-    directions = ((camera_dirs[None, Ellipsis, None, :] *
-                   self.random_poses[:, None, None, :3, :3]).sum(axis=-1))
-    origins = np.broadcast_to(self.random_poses[:, None, None, :3, -1],
-                              directions.shape)
-    viewdirs = directions / np.linalg.norm(directions, axis=-1, keepdims=True)
-
-    # Distance from each unit-norm direction vector to its x-axis neighbor.
-    dx = np.sqrt(
-        np.sum((directions[:, :-1, :, :] - directions[:, 1:, :, :])**2, -1))
-    dx = np.concatenate([dx, dx[:, -2:-1, :]], axis=1)
-    # Cut the distance in half, multiply it to match the variance of a uniform
-    # distribution the size of a pixel (1/12, see paper).
-    radii = dx[Ellipsis, None] * 2 / np.sqrt(12)
-
-    ones = np.ones_like(origins[Ellipsis, :1])
-    self.random_fullimage_rays = utils.Rays(
-        origins=origins,
-        directions=directions,
-        viewdirs=viewdirs,
-        radii=radii,
-        lossmult=ones,
-        near=ones * self.near,
-        far=ones * self.far)
+    # Pixel centers are shifted by an extra half pixel here.
+    self.random_fullimage_rays = cast_rays(
+        generate_pinhole_rays(self.random_poses, width, height, f, self.near,
+                              self.far, pixel_offset=1.),
+        self.ray_dtype, self.radii_dtype)
 
   def _generate_downsampled_images(self, config):
     """Generating downsampled images."""
     images = []
     resolutions = []
+    n, height, width = self.images.shape[:3]
     for sfactor in [2**i for i in range(config.recon_loss_scales)]:
-      # print("single image shape:",self.images[0].shape)
-      imgi = np.stack([downsample(i, sfactor) for i in self.images])
+      # Each image is resized straight into its slot of the scale's array.
+      imgi = np.empty((n, height // sfactor, width // sfactor) +
+                      self.images.shape[3:], self.images.dtype)
+      _thread_map(
+          lambda i: downsample(self.images[i], sfactor, dst=imgi[i]),  # pylint: disable=cell-var-from-loop
+          range(n))
       images.append(imgi)
-      # print("single image shape:",imgi.shape)
       resolutions.append(imgi.shape[1] * imgi.shape[2])
 
     self.images = images
@@ -804,6 +1310,18 @@ class Dataset(threading.Thread):
     """Generating downsampled images."""
     rays, height, width, focal = self.rays, self.height, self.width, self.focal
     ray_list = [rays]
+    if config.strided_downsampled_rays:
+      for sfactor in [2**i for i in range(1, config.recon_loss_scales)]:
+        h, w = height // sfactor * sfactor, width // sfactor * sfactor
+        strided = {k: v[:, :h:sfactor, :w:sfactor]
+                   for k, v in vars(rays).items()}
+        # Pinhole directions are affine in the pixel coordinates, so the
+        # neighbor distance and hence the radii grow exactly by `sfactor`.
+        strided['radii'] = strided['radii'] * np.asarray(sfactor,
+                                                         rays.radii.dtype)
+        ray_list.append(utils.Rays(**strided))
+      self.rays = ray_list
+      return
     for sfactor in [2**i for i in range(1, config.recon_loss_scales)]:
       self.height = height // sfactor
       self.width = width // sfactor
@@ -829,16 +1347,16 @@ class Multicam(Dataset):
     self.meta = {k: np.array(self.meta[k]) for k in self.meta}
     # Should now have ['pix2cam', 'cam2world', 'width', 'height'] in self.meta.
     # print(self.meta)
-    images = []
 
-    for fbase in self.meta['file_path']:
-      print('file path:', fbase)
+    def load_image(fbase):
       fname = os.path.join(self.data_dir, fbase)
       with utils.open_file(fname, 'rb') as imgin:
         image = np.array(Image.open(imgin), dtype=np.float32) / 255.
       if config.white_background:
         image = image[Ellipsis, :3] * image[Ellipsis, -1:] + (1. - image[Ellipsis, -1:])
-      images.append(image[Ellipsis, :3])
+      return image[Ellipsis, :3]
+
+    images = _thread_map(load_image, self.meta['file_path'])
 
     self.images = np.stack(images, axis = 0)
     print("image shape after stack:", self.images.shape)
@@ -869,25 +1387,19 @@ class Multicam(Dataset):
 
     print("-----using multicam init----")
 
-    def flatten(x):
-      # Always flatten out the height x width dimensions
-      x = [y.reshape([-1, y.shape[-1]]) for y in x]
-      if config.batching == 'all_images':
-        # If global batching, also concatenate all data into one list
-        x = np.concatenate(x, axis=0)
-      return x
-    # self.images = np.stack(self.images, axis=0)
-    self.images = flatten(self.images)
-    self.images = np.stack(self.images, axis=0)
-    print("after stack:",self.images.shape)
-    self.images = [self.images]
-
-    self.ray_noreshape = [self.rays]
-    # print("rays:",self.rays)   
-    self.rays = [self.rays] 
-    self.rays = [utils.dataclass_map(lambda r: r.reshape(  # pylint: disable=g-long-lambda
-        [-1, res, r.shape[-1]]), i) for (i, res) in  # pylint: disable=cell-var-from-loop
-                  zip(self.rays, self.resolutions)]
+    # Always flatten out the height x width dimensions, and for global batching
+    # the image dimension too; both are views of the stacked images.
+    n, channels = self.images.shape[0], self.images.shape[-1]
+    if config.batching == 'all_images':
+      self.images = [self.images.reshape(-1, channels)]
+    else:
+      self.images = [self.images.reshape(n, -1, channels)]
+    print("after stack:",self.images[0].shape)
+    if self.uint8_images:
+      self.images = [quantize_images(self.images[0])]
+
+    self.rays = [self.rays]
+    self._pack_train_rays(config)
     # print("rays:",self.rays)  
 
   def _test_init(self, config):
@@ -905,71 +1417,36 @@ class Multicam(Dataset):
     height = self.meta['height']
     self.resolutions = width * height
 
-    def res2grid(w, h):
-      return np.meshgrid(  # pylint: disable=unbalanced-tuple-unpacking
-          np.arange(w, dtype=np.float32) + .5,  # X-Axis (columns)
-          np.arange(h, dtype=np.float32) + .5,  # Y-Axis (rows)
-          indexing='xy')
-
-    xy = [res2grid(w, h) for w, h in zip(width, height)]
-    pixel_dirs = [np.stack([x, y, np.ones_like(x)], axis=-1) for x, y in xy]
-
-    print("pixel_dirs shape:",pixel_dirs[0].shape, "pixcel_dir len:", len(pixel_dirs))
-
-    camera_dirs = [v @ p2c[:3, :3].T for v, p2c in zip(pixel_dirs, pix2cam)]
-    camera_dirs = np.stack(camera_dirs, axis=0)
-
-    directions = [v @ c2w[:3, :3].T for v, c2w in zip(camera_dirs, cam2world)]
-    directions = [-d[:, ::-1] for d in directions]
-    directions = np.stack(directions, axis=0)
-    origins = [
-        np.broadcast_to(c2w[:3, -1], v.shape)
-        for v, c2w in zip(directions, cam2world)
-    ]
-    origins = np.stack(origins, axis=0)
-    viewdirs = [
-        v / np.linalg.norm(v, axis=-1, keepdims=True) for v in directions
-    ]
-    viewdirs = np.stack(viewdirs,axis=0)
-
-    def broadcast_scalar_attribute(x):
-      return [
-          np.broadcast_to(x[i], origins[i][Ellipsis, :1].shape)
-          for i in range(self.n_examples)
-      ]
-
-    lossmult = broadcast_scalar_attribute(self.meta['lossmult'])
-    near = broadcast_scalar_attribute(self.meta['near'])
-    far = broadcast_scalar_attribute(self.meta['far'])
-    ones = np.ones_like(origins[Ellipsis, :1])
+    fields = self._multicam_ray_fields(pix2cam, cam2world, width, height)
+    camera_dirs, directions, viewdirs, radii = (
+        fields[k] for k in ('camera_dirs', 'directions', 'viewdirs', 'radii'))
+    origins = np.broadcast_to(cam2world[:, None, None, :3, -1],
+                              directions.shape)
+
+    shape = directions.shape[:-1] + (1,)
+    near = self.meta['near']
+    far = self.meta['far']
     self.near = config.near
     self.far = config.far
-    # Distance from each unit-norm direction vector to its x-axis neighbor.
-    dx = [
-        np.sqrt(np.sum((v[:-1, :, :] - v[1:, :, :])**2, -1)) for v in directions
-    ]
-    dx = [np.concatenate([v, v[-2:-1, :]], axis=0) for v in dx]
-    # Cut the distance in half, and then round it out so that it's
-    # halfway between inscribed by / circumscribed about the pixel.
-    radii = [v[Ellipsis, None] * 2 / np.sqrt(12) for v in dx]
-    radii = np.stack(radii,axis=0)
-
-    self.rays = utils.Rays(
+
+    self.rays = cast_rays(utils.Rays(
         origins=origins,
         directions=directions,
         viewdirs=viewdirs,
         radii=radii,
-        lossmult=ones,
-        near=ones * self.near,
-        far=ones * self.far)
+        lossmult=_broadcast_scalar(1., shape),
+        times=_broadcast_scalar(0., shape),
+        near=_broadcast_scalar(self.near, shape),
+        far=_broadcast_scalar(self.far, shape)),
+                          self.ray_dtype, self.image_radii_dtype)
     
     self.camtoworlds_all = camera_dirs
     print("self.camtoworld_all shape:",self.camtoworlds_all.shape)
-    self.bounds = np.stack([near, far], axis=-1)
+    self.bounds = np.broadcast_to(
+        np.stack([near, far], axis=-1)[:self.n_examples, None, None, None],
+        (self.n_examples,) + shape[1:] + (2,))
     
-    with open('/media/pleasework/Storage/regnerf/New_Dev/debug/regnerf_rays_dan_multicam.txt', 'w') as f:
-
-      f.write(str(self.rays))
+    self._debug_dump('regnerf_rays_dan_multicam.txt', self.rays)
 
   def _generate_random_poses(self, config):
     """Generates random poses."""
@@ -994,18 +1471,15 @@ class Multicam(Dataset):
 
     radii = np.concatenate([radii, [1.]])
 
-    # Generate random poses.
-    random_poses = []
+    # Generate all random poses at once.
     cam2world = poses_avg(poses)
     up = poses[:, :3, 1].mean(0)
-    for _ in range(n_poses):
-      t = radii * np.concatenate([2 * np.random.rand(3) - 1., [1,]])
-      position = cam2world @ t
-      lookat = cam2world @ [0, 0, -focal, 1.]
-      z_axis = position - lookat
-    
-    random_poses.append(viewmatrix(z_axis, up, position))
-    self.random_poses = np.stack(random_poses, axis=0)
+    t = radii * np.concatenate(
+        [2 * np.random.rand(n_poses, 3) - 1., np.ones((n_poses, 1))], axis=-1)
+    positions = t @ cam2world.T
+    lookat = cam2world @ [0, 0, -focal, 1.]
+    z_axis = positions - lookat
+    self.random_poses = viewmatrix(z_axis, up, positions)
 
   def _generate_random_rays(self, config):
     """Generates random rays."""
@@ -1018,24 +1492,11 @@ class Multicam(Dataset):
     height = self.meta['height']
     self.resolutions = width * height
 
-    def res2grid(w, h):
-      return np.meshgrid(  # pylint: disable=unbalanced-tuple-unpacking
-          np.arange(w, dtype=np.float32) + .5,  # X-Axis (columns)
-          np.arange(h, dtype=np.float32) + .5,  # Y-Axis (rows)
-          indexing='xy')
-
-    xy = [res2grid(w, h) for w, h in zip(width, height)]
-    pixel_dirs = [np.stack([x, y, np.ones_like(x)], axis=-1) for x, y in xy]
-
-    print("pixel_dirs shape:",pixel_dirs[0].shape, "pixcel_dir len:", len(pixel_dirs))
-
-    camera_dirs = [v @ p2c[:3, :3].T for v, p2c in zip(pixel_dirs, pix2cam)]
-    camera_dirs = np.stack(camera_dirs, axis=0)
-    directions = ((camera_dirs[None, Ellipsis, None, :] *
-                     camtoworlds[:, None, None, :3, :3]).sum(axis=-1))
-    origins = np.broadcast_to(camtoworlds[:, None, None, :3, -1],
-                                directions.shape)
-    viewdirs = directions / np.linalg.norm(directions, axis=-1, keepdims=True)
+    # Each random pose is seen through one rig camera drawn from the
+    # dataset's generator, so the random rays hold one image per pose like
+    # the pinhole datasets. Poses are grouped by the resolution of their
+    # camera, `subsample_patches` then samples each patch from one group.
+    cams = self._rng.integers(len(pix2cam), size=len(camtoworlds))
 
     # def broadcast_scalar_attribute(x):
     #   return [
@@ -1046,31 +1507,32 @@ class Multicam(Dataset):
     # lossmult = broadcast_scalar_attribute(self.meta['lossmult'])
     # near = broadcast_scalar_attribute(self.meta['near'])
     # far = broadcast_scalar_attribute(self.meta['far'])
-    ones = np.ones_like(origins[Ellipsis, :1])
     self.near = 2
     self.far = 6
-    # Distance from each unit-norm direction vector to its x-axis neighbor.
-    dx = [
-        np.sqrt(np.sum((v[:-1, :, :] - v[1:, :, :])**2, -1)) for v in directions
-    ]
-    dx = [np.concatenate([v, v[-2:-1, :]], axis=0) for v in dx]
-    # Cut the distance in half, and then round it out so that it's
-    # halfway between inscribed by / circumscribed about the pixel.
-    radii = [v[Ellipsis, None] * 2 / np.sqrt(12) for v in dx]
-    radii = np.stack(radii,axis=0)
-
-    self.random_rays = utils.Rays(
-        origins=origins[0],
-        directions=directions[0],
-        viewdirs=viewdirs[0],
-        radii=radii[0],
-        lossmult=ones[0],
-        near=ones[0] * self.near,
-        far=ones[0] * self.far)
-    self.random_rays = [self.random_rays] 
-    with open('/home/pleasework/Desktop/Neural-motion-capture/debug/random_rays_dan_multicam.txt', 'w') as f:
-
-      f.write(str(self.random_rays))
+
+    self.random_rays = []
+    for (w, h), idx in _resolution_groups(width, height).items():
+      poses = np.flatnonzero(np.isin(cams, idx))
+      if not len(poses):
+        continue
+      directions, viewdirs, radii = (
+          np.asarray(x) for x in _multicam_random_rays(
+              pix2cam[cams[poses], :3, :3], camtoworlds[poses, :3, :3], w, h))
+      # Per-image origins and constants are broadcast over the pixels.
+      origins = np.broadcast_to(camtoworlds[poses, None, None, :3, -1],
+                                directions.shape)
+      shape = directions.shape[:-1] + (1,)
+      self.random_rays.append(cast_rays(utils.Rays(
+          origins=origins,
+          directions=directions,
+          viewdirs=viewdirs,
+          radii=radii,
+          lossmult=_broadcast_scalar(1., shape),
+          times=_broadcast_scalar(0., shape),
+          near=_broadcast_scalar(self.near, shape),
+          far=_broadcast_scalar(self.far, shape)),
+          self.ray_dtype, self.radii_dtype))
+    self._debug_dump('random_rays_dan_multicam.txt', self.random_rays)
 
 
 class Blender(Dataset):
@@ -1084,11 +1546,7 @@ class Blender(Dataset):
     with utils.open_file(
         path.join(self.data_dir, f'transforms_{self.split}.json'), 'r') as fp:
       meta = json.load(fp)
-    images = []
-    disp_images = []
-    normal_images = []
-    cams = []
-    for frame in meta['frames']:
+    def load_frame(frame):
       fprefix = os.path.join(self.data_dir, frame['file_path'])
       if self.use_tiffs:
         channels = []
@@ -1101,6 +1559,7 @@ class Blender(Dataset):
         with utils.open_file(fprefix + '.png', 'rb') as imgin:
           image = np.array(Image.open(imgin), dtype=np.float32) / 255.
 
+      disp_image = normal_image = None
       if self.load_disps:
         with utils.open_file(fprefix + '_disp.tiff', 'rb') as imgin:
           disp_image = np.array(Image.open(imgin), dtype=np.float32)
@@ -1115,13 +1574,12 @@ class Blender(Dataset):
           disp_image = downsample(disp_image, config.factor)
         if self.load_normals:
           normal_image = downsample(normal_image, config.factor)
+      return image, disp_image, normal_image
 
-      cams.append(np.array(frame['transform_matrix'], dtype=np.float32))
-      images.append(image)
-      if self.load_disps:
-        disp_images.append(disp_image)
-      if self.load_normals:
-        normal_images.append(normal_image)
+    images, disp_images, normal_images = zip(
+        *_thread_map(load_frame, meta['frames']))
+    cams = [np.array(frame['transform_matrix'], dtype=np.float32)
+            for frame in meta['frames']]
 
     self.images = np.stack(images, axis=0)
     if self.load_disps:
@@ -1165,6 +1623,9 @@ class Multicam_video(Dataset):
       videos = []
       cap = cv2.VideoCapture(os.path.join(self._path_videodir, f'cam_1.mp4'))
       self.time_frame_num = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+      frame_shape = (int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                     int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), 3)
+      cap.release()
       print("self.time_frame_num:", self.time_frame_num)
       print("we have {self.time_frame_num} frames in total for each videos from each camera.")
       
@@ -1188,35 +1649,44 @@ class Multicam_video(Dataset):
       cam_num = pix2cam.shape[0]
       print("cam_num:", cam_num)
 
-      img_all = []
-      
-
-      # for i in range(self.time_frame_num):
-      for frame_idx in range(self.start_frame, self.end_frame):
-        img_temp = []
-        # print("frame idx:", frame_idx)
+      # Every frame is decoded straight into one preallocated uint8
+      # [F, N, H, W, 3] tensor. Each worker owns one camera's capture: it is
+      # opened once, seeked to the first frame, and decoded sequentially.
+      img_all = np.empty(
+          (self.end_frame - self.start_frame, cam_num) + frame_shape, np.uint8)
+
+      def decode_camera(cam_idx):
+        cam_temp = cv2.VideoCapture(os.path.join(self._path_videodir, f'cam_{cam_idx+1}.mp4'))
+        cam_temp.set(cv2.CAP_PROP_POS_FRAMES, self.start_frame)
+        try:
+          for t, frame_idx in enumerate(range(self.start_frame, self.end_frame)):
+            ret, frame = cam_temp.read(img_all[t, cam_idx])
+            if not ret:
+              raise ValueError(
+                  f'cam_{cam_idx+1}.mp4 has no frame {frame_idx}.')
+            if not np.shares_memory(frame, img_all):
+              img_all[t, cam_idx] = frame
+            if self.debug_dump:
+              cv2.imwrite(os.path.join(self.checkpointdir, f'cam_{cam_idx+1}_{frame_idx}.png'), frame)
+        finally:
+          cam_temp.release()
+
+      # One decoder thread per camera, so keep OpenCV from nesting its own.
+      cv2_threads = cv2.getNumThreads()
+      cv2.setNumThreads(1)
+      try:
+        _thread_map(decode_camera, range(cam_num))
+      finally:
+        cv2.setNumThreads(cv2_threads)
 
-      
-        for cam_idx in range(cam_num):
-          cam_temp = cv2.VideoCapture(os.path.join(self._path_videodir, f'cam_{cam_idx+1}.mp4'))
-          # print("cap", cam_idx+1, "generated!")
-          # read the frame from the video and append to the img_temp
-          cam_temp.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
-          ret, frame = cam_temp.read()
-  
-          if config.white_background:
-            frame = frame[Ellipsis, :3] * frame[Ellipsis, -1:] + (1. - frame[Ellipsis, -1:])
-
-          img_temp.append(frame)
-          cv2.imwrite(os.path.join(self.checkpointdir, f'cam_{cam_idx+1}_{frame_idx}.png'), frame)
-          
-        images_per_frame = np.stack(img_temp, axis=0)
-        # print("frame shape:", frame.shape, "img_temp len:", len(img_temp))
-        img_all.append(images_per_frame)
-        
       print("image all len and  shapes:", len(img_all), img_all[0].shape)
 
-      self.images = img_all[0]
+      # Only the first frame is trained on; copy it out so the rest of the
+      # decoded frames are freed with `img_all`.
+      self.images = img_all[0].copy()
+      del img_all
+      if config.white_background:
+        self.images = self.images[Ellipsis, :3] * self.images[Ellipsis, -1:] + (1. - self.images[Ellipsis, -1:])
       
       print("self image shape: ",self.images.shape)
       self.n_examples = len(self.images)
@@ -1266,39 +1736,24 @@ class Multicam_video(Dataset):
     # if self.load_random_fullimage_rays:
     #   self._generate_random_fullimage_rays(config)
     #   self._load_renderings_featloss(config)
-    with open('/media/pleasework/Storage/regnerf/New_Dev/debug/pop-dict.txt', 'w') as f:
-      f.write(str(self.rays))
+    self._debug_dump('pop-dict.txt', self.rays)
 
     self.it = 0
     self.images_noreshape = self.images[0]
 
     print("-----using multicam_video init----")
 
-    def flatten(x):
-      # Always flatten out the height x width dimensions
-      x = [y.reshape([-1, y.shape[-1]]) for y in x]
-      if config.batching == 'all_images':
-        # If global batching, also concatenate all data into one list
-        x = np.concatenate(x, axis=0)
-        
-      print('x shape after flatten/concatenate:', \
-            x[0].shape, "length:", len(x))
-        
-      return x
-    
-    # self.images = np.stack(self.images, axis=0)
-    self.images = flatten(self.images)
-    self.images = np.stack(self.images, axis=0)
-    # print("after stack:",self.images.shape)
-    self.images = [self.images]
-
-    self.ray_noreshape = [self.rays]
-    # print("rays:",self.rays)   
-    self.rays = [self.rays] 
-    self.rays = [utils.dataclass_map(lambda r: r.reshape(  # pylint: disable=g-long-lambda
-        [-1, res, r.shape[-1]]), i) for (i, res) in  # pylint: disable=cell-var-from-loop
-                  zip(self.rays, self.resolutions)]
-      # print("rays:",self.rays)  
+    # Always flatten out the height x width dimensions, and for global batching
+    # the image dimension too; both are views of the stacked images.
+    n, channels = self.images.shape[0], self.images.shape[-1]
+    if config.batching == 'all_images':
+      self.images = [self.images.reshape(-1, channels)]
+    else:
+      self.images = [self.images.reshape(n, -1, channels)]
+    print("after stack:",self.images[0].shape)
+
+    self.rays = [self.rays]
+    self._pack_train_rays(config)
 
   def _test_init(self, config):
     self._load_renderings(config)
@@ -1316,107 +1771,67 @@ class Multicam_video(Dataset):
     self.resolutions = width * height
     
 
-    def res2grid(w, h):
-      return np.meshgrid(  # pylint: disable=unbalanced-tuple-unpacking
-          np.arange(w, dtype=np.float32) + .5,  # X-Axis (columns)
-          np.arange(h, dtype=np.float32) + .5,  # Y-Axis (rows)
-          indexing='xy')
-
-    xy = [res2grid(w, h) for w, h in zip(width, height)]
-    pixel_dirs = [np.stack([x, y, np.ones_like(x)], axis=-1) for x, y in xy]
-
-    # print("pixel_dirs shape:",pixel_dirs[0].shape, "pixcel_dir len:", len(pixel_dirs))
-
-    camera_dirs = [v @ p2c[:3, :3].T for v, p2c in zip(pixel_dirs, pix2cam)]
-    camera_dirs = np.stack(camera_dirs, axis=0)
-    
-    # copy camera_dirs 8 time and concat them together:
-    camera_dirs = np.tile(camera_dirs, (self.render_frame, 1, 1, 1))
+    # Every field is computed once per camera, then repeated per frame.
+    fields = self._multicam_ray_fields(pix2cam, cam2world, width, height)
+    camera_dirs, directions, viewdirs, radii = (
+        np.tile(fields[k], (self.render_frame, 1, 1, 1))
+        for k in ('camera_dirs', 'directions', 'viewdirs', 'radii'))
     
     print("camera_dirs shape after tile:",camera_dirs.shape)
     
     
-    # directions ......
-    directions = [v @ c2w[:3, :3].T for v, c2w in zip(camera_dirs, cam2world)]
-    directions = [-d[:, ::-1] for d in directions]
-    directions = np.stack(directions, axis=0)
-    directions = np.tile(directions, (self.render_frame, 1, 1, 1))
-    
-    
     # origins ...... 
-    origins = [
-        np.broadcast_to(c2w[:3, -1], v.shape)
-        for v, c2w in zip(directions, cam2world)
-    ]
-    origins = np.stack(origins, axis=0)
-    origins = np.tile(origins, (self.render_frame, 1, 1, 1))
+    origins = np.broadcast_to(
+        np.tile(cam2world, (self.render_frame, 1, 1))[:, None, None, :3, -1],
+        directions.shape)
     
     
-    # viewdirs.......
-    viewdirs = [
-        v / np.linalg.norm(v, axis=-1, keepdims=True) for v in directions
-    ]
-    viewdirs = np.stack(viewdirs,axis=0)
     print("viewdirs shape:",viewdirs.shape)
-    viewdirs = np.tile(viewdirs, (self.render_frame, 1, 1, 1))
-
-    def broadcast_scalar_attribute(x):
-      return [
-          np.broadcast_to(x[i], origins[i][Ellipsis, :1].shape)
-          for i in range(self.n_examples)
-      ]
-
-
 
     # lossmult, near, far and onesss...
-    # lossmult = broadcast_scalar_attribute(self.meta['lossmult'])
-    near = broadcast_scalar_attribute(self.meta['near'])
-    far = broadcast_scalar_attribute(self.meta['far'])
-    ones = np.ones_like(origins[Ellipsis, :1])    
-    print("ones.shape:", ones.shape)
+    shape = directions.shape[:-1] + (1,)
+    near = self.meta['near']
+    far = self.meta['far']
     
     
     # times..............
-    times = np.ones_like(origins[Ellipsis, :1])   
-    print("times.example:", times[1,:,:,0])
+    # One time value per image, the images of frame i hold i + 1.
+    times = np.ones(shape[0], np.float32)
     for i in range(self.render_frame):
-      times[i*20:(i+1)*20,:,:,:] = times[i*20:(i+1)*20,:,:,:]*(i+1)
-      print("times.example:", times[1,:,:,0])
+      times[i*20:(i+1)*20] = times[i*20:(i+1)*20]*(i+1)
+    times = np.broadcast_to(times[:, None, None, None], shape)
         
     print("times shape:", times.shape)
-    np.savetxt("/media/pleasework/Storage/regnerf/New_Dev/out/times1.txt", times[10,:,:,0])
-    np.savetxt("/media/pleasework/Storage/regnerf/New_Dev/out/times2.txt", times[30,:,:,0])
+    if self.debug_dump:
+      debug_dir = os.path.join(self.checkpointdir, 'debug')
+      os.makedirs(debug_dir, exist_ok=True)
+      np.savetxt(os.path.join(debug_dir, 'times1.txt'), times[10, :, :, 0])
+      np.savetxt(os.path.join(debug_dir, 'times2.txt'), times[30, :, :, 0])
     
     self.near = config.near
     self.far = config.far
-    # Distance from each unit-norm direction vector to its x-axis neighbor.
-    dx = [
-        np.sqrt(np.sum((v[:-1, :, :] - v[1:, :, :])**2, -1)) for v in directions
-    ]
-    dx = [np.concatenate([v, v[-2:-1, :]], axis=0) for v in dx]
-    # Cut the distance in half, and then round it out so that it's
-    # halfway between inscribed by / circumscribed about the pixel.
-    radii = [v[Ellipsis, None] * 2 / np.sqrt(12) for v in dx]
-    radii = np.stack(radii,axis=0)
     print("radii shape:", radii.shape)
 
 
     # those origins, directions, viewdirs, radii, lossmult, near, far should be idx independent for
     # every timeframe and also, idx, will check out later and add................
 
-    self.rays = utils.Rays(
+    self.rays = cast_rays(utils.Rays(
         origins=origins,
         directions=directions,
         viewdirs=viewdirs,
         radii=radii,
-        lossmult=ones,
+        lossmult=_broadcast_scalar(1., shape),
         times=times,
-        near=ones * self.near,
-        far=ones * self.far)
+        near=_broadcast_scalar(self.near, shape),
+        far=_broadcast_scalar(self.far, shape)),
+                          self.ray_dtype, self.image_radii_dtype)
     
     self.camtoworlds_all = camera_dirs
     # print("self.camtoworld_all shape:",self.camtoworlds_all.shape)
-    self.bounds = np.stack([near, far], axis=-1)
+    self.bounds = np.broadcast_to(
+        np.stack([near, far], axis=-1)[:self.n_examples, None, None, None],
+        (self.n_examples,) + shape[1:] + (2,))
     
 
   # def _generate_random_poses(self, config):
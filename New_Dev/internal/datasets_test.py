@@ -0,0 +1,204 @@
+# coding=utf-8
+# Copyright 2022 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for datasets."""
+import os
+from unittest import mock
+
+from absl.testing import absltest
+from absl.testing import parameterized
+from internal import configs
+from internal import datasets
+import numpy as np
+
+
+class _RandomDataset(datasets.Dataset):
+  """Three random pinhole images, enough to build training batches."""
+
+  def _load_renderings(self, config):
+    rng = np.random.default_rng(0)
+    self.images = rng.random((3, 12, 16, 3)).astype(np.float32)
+    self.camtoworlds = np.tile(np.eye(4, dtype=np.float32)[:3], (3, 1, 1))
+    self.height, self.width = 12, 16
+    self.resolution = self.height * self.width
+    self.focal = 10.
+    self.n_examples = 3
+
+
+def _reference_pinhole_rays(camtoworlds, width, height, focal):
+  """The per-pixel pinhole ray formulas, one image at a time."""
+  x, y = np.meshgrid(np.arange(width), np.arange(height), indexing='xy')
+  camera_dirs = np.stack([(x - width * 0.5 + 0.5) / focal,
+                          -(y - height * 0.5 + 0.5) / focal,
+                          -np.ones_like(x)], axis=-1)
+  directions = np.stack([camera_dirs @ c2w[:3, :3].T for c2w in camtoworlds])
+  viewdirs = directions / np.linalg.norm(directions, axis=-1, keepdims=True)
+  dx = np.linalg.norm(directions[:, :-1] - directions[:, 1:], axis=-1)
+  dx = np.concatenate([dx, dx[:, -1:]], axis=1)
+  return directions, viewdirs, dx[Ellipsis, None] * 2 / np.sqrt(12)
+
+
+def _reference_multicam_rays(p2c, c2w, width, height):
+  """The per-pixel Multicam ray formulas of a single camera."""
+  x, y = np.meshgrid(np.arange(width) + .5, np.arange(height) + .5,
+                     indexing='xy')
+  camera_dirs = np.stack([x, y, np.ones_like(x)], axis=-1) @ p2c.T
+  directions = -(camera_dirs @ c2w[:3, :3].T)[:, ::-1]
+  viewdirs = directions / np.linalg.norm(directions, axis=-1, keepdims=True)
+  dx = np.linalg.norm(directions[:-1] - directions[1:], axis=-1)
+  dx = np.concatenate([dx, dx[-1:]], axis=0)
+  return camera_dirs, directions, viewdirs, dx[Ellipsis, None] * 2 / np.sqrt(12)
+
+
+def _random_rotations(n, rng):
+  """Returns [n, 3, 4] camera to world matrices with random rotations."""
+  q, _ = np.linalg.qr(rng.normal(size=(n, 3, 3)))
+  return np.concatenate([q, rng.normal(size=(n, 3, 1))], axis=-1)
+
+
+class DatasetsTest(parameterized.TestCase):
+
+  def _maybe_without_numba(self, use_numba):
+    """Returns a context that runs the NumPy ray path unless `use_numba`."""
+    if use_numba:
+      if datasets.numba is None:
+        self.skipTest('numba is not installed.')
+      return mock.patch.object(datasets, 'numba', datasets.numba)
+    return mock.patch.object(datasets, 'numba', None)
+
+  @parameterized.parameters(True, False)
+  def test_generate_pinhole_rays(self, use_numba):
+    rng = np.random.default_rng(0)
+    camtoworlds = _random_rotations(2, rng)
+    with self._maybe_without_numba(use_numba):
+      rays = datasets.generate_pinhole_rays(camtoworlds, 7, 5, 4., 2., 6.)
+    directions, viewdirs, radii = _reference_pinhole_rays(camtoworlds, 7, 5,
+                                                          4.)
+    np.testing.assert_allclose(rays.directions, directions, atol=1e-5)
+    np.testing.assert_allclose(rays.viewdirs, viewdirs, atol=1e-5)
+    np.testing.assert_allclose(rays.radii, radii, atol=1e-5)
+    np.testing.assert_allclose(
+        rays.origins,
+        np.broadcast_to(camtoworlds[:, None, None, :, 3], directions.shape),
+        atol=1e-6)
+    np.testing.assert_array_equal(rays.near, 2.)
+    np.testing.assert_array_equal(rays.far, 6.)
+    self.assertEqual(rays.near.shape, radii.shape)
+
+  @parameterized.parameters(True, False)
+  def test_multicam_rays(self, use_numba):
+    rng = np.random.default_rng(0)
+    pix2cam = rng.normal(size=(3, 3, 3)).astype(np.float32)
+    cam2world = _random_rotations(3, rng)
+    # Two of the cameras share a resolution, the third one does not.
+    width, height = np.array([6, 4, 6]), np.array([5, 3, 5])
+    with self._maybe_without_numba(use_numba):
+      fields = datasets._multicam_rays(pix2cam, cam2world, width, height)
+    for i in range(3):
+      reference = _reference_multicam_rays(pix2cam[i], cam2world[i], width[i],
+                                           height[i])
+      for field, expected in zip(fields, reference):
+        np.testing.assert_allclose(field[i], expected, rtol=1e-4, atol=1e-4)
+
+  def test_pack_unpack_rays_round_trip(self):
+    rays = datasets.generate_pinhole_rays(
+        _random_rotations(2, np.random.default_rng(0)), 4, 3, 2., 2., 6.)
+    packed, layout = datasets.pack_rays(rays, exclude=('origins', 'near'))
+    self.assertEqual(packed.shape, (2, 3, 4, 10))
+    unpacked = datasets.unpack_rays(packed, layout, origins=rays.origins,
+                                    near=rays.near)
+    for k, v in vars(rays).items():
+      np.testing.assert_array_equal(getattr(unpacked, k), v)
+
+  @parameterized.parameters('all_images', 'single_image')
+  def test_gather_rays_matches_generated_rays(self, batching):
+    config = configs.Config(batching=batching, load_random_rays=False)
+    dataset = _RandomDataset('train', '', config)
+    rays = datasets.generate_pinhole_rays(
+        dataset.camtoworlds, dataset.width, dataset.height, dataset.focal,
+        config.near, config.far)
+    flat = {k: v.reshape(3, -1, v.shape[-1]) for k, v in vars(rays).items()}
+    ray_indices = np.array([0, 5, 191])
+    if batching == 'all_images':
+      gathered = dataset._gather_rays(0, ray_indices + 192)
+      image_index = 1
+    else:
+      image_index = 2
+      gathered = dataset._gather_rays(0, ray_indices, image_index)
+    for k, v in flat.items():
+      np.testing.assert_allclose(
+          getattr(gathered, k), v[image_index][ray_indices], rtol=1e-6)
+
+  def test_subsample_patches(self):
+    # Every pixel holds its (image, row, column) index.
+    images = np.stack(np.meshgrid(
+        np.arange(3), np.arange(12), np.arange(16), indexing='ij'), axis=-1)
+    patches, scale = datasets.subsample_patches(
+        [images], 4, 64, np.random.default_rng(0))
+    self.assertEqual(patches.shape, (64, 3))
+    np.testing.assert_array_equal(scale, np.zeros((4, 1)))
+    offsets = datasets.patch_offsets(4)[0]
+    for patch in patches.reshape(4, 16, 3):
+      np.testing.assert_array_equal(patch[:, 0], patch[0, 0])
+      np.testing.assert_array_equal(patch[:, 1] - patch[0, 1], offsets[:, 1])
+      np.testing.assert_array_equal(patch[:, 2] - patch[0, 2], offsets[:, 0])
+
+  def test_ray_cache_key_is_versioned(self):
+    cache_dir = self.create_tempdir().full_path
+    config = configs.Config(load_random_rays=False, ray_cache_dir=cache_dir)
+    dataset = _RandomDataset('train', '', config)
+    calls = []
+
+    def generate():
+      calls.append(None)
+      return {'x': np.arange(3.)}
+
+    key = np.eye(3, dtype=np.float32)
+    dataset._cached_arrays('rays', generate, key)
+    cached = dataset._cached_arrays('rays', generate, key)
+    self.assertLen(calls, 1)
+    np.testing.assert_array_equal(cached['x'], np.arange(3.))
+    with mock.patch.object(datasets, '_RAY_CACHE_VERSION',
+                           datasets._RAY_CACHE_VERSION + 1):
+      dataset._cached_arrays('rays', generate, key)
+    self.assertLen(calls, 2)
+    self.assertLen(os.listdir(cache_dir), 2)
+
+  def test_images_to_float(self):
+    images = np.array([0, 128, 255], np.uint8)
+    np.testing.assert_allclose(
+        datasets.images_to_float(images), images / 255., rtol=1e-6)
+    self.assertEqual(datasets.images_to_float(images).dtype, np.float32)
+    floats = np.linspace(0., 1., 5, dtype=np.float32)
+    self.assertIs(datasets.images_to_float(floats), floats)
+
+  @parameterized.parameters('all_images', 'single_image')
+  def test_uint8_images_batches_are_float(self, batching):
+    batches = {}
+    for uint8_images in [False, True]:
+      config = configs.Config(batching=batching, batch_size=64,
+                              load_random_rays=False,
+                              uint8_images=uint8_images)
+      # the same seed draws the same batches from both datasets.
+      np.random.seed(0)
+      batches[uint8_images] = next(_RandomDataset('train', '', config))
+    rgb = np.asarray(batches[True]['rgb'])
+    self.assertEqual(rgb.dtype, np.float32)
+    np.testing.assert_allclose(
+        rgb, np.asarray(batches[False]['rgb']), atol=.5 / 255. + 1e-6)
+
+
+if __name__ == '__main__':
+  absltest.main()